@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+# "Autobox" dongle driver for HTML 'streaming' - benchmarks
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Benchmarks for the CPU-heavy parts of the driver, to compare implementations on the target hardware."""
+import argparse
+import functools
+import random
+import resource
+import struct
+import time
+import timeit
+import h264
+import decoder
+
+def _cpu_time():
+    """CPU seconds used by this process and any children that have been waited for."""
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+def bench_decoder(args):
+    with open(args.file, "rb") as f:
+        frames = h264.access_units(f.read())
+    for name in args.backend or sorted(decoder.backends):
+        class _Counter(decoder.Decoder):
+            idle_timeout = float("inf")
+            count = 0
+            last = 0
+            def on_frame(self, png):
+                self.count += 1
+                self.last = time.monotonic()
+        try:
+            dec = _Counter(name)
+        except ImportError as e:
+            print(f"{name}: unavailable ({e})")
+            continue
+        dec.demand()
+        cpu = _cpu_time()
+        start = time.monotonic()
+        for i, frame in enumerate(frames):
+            dec.send(frame)
+            delay = start + (i + 1) / args.rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        # Let the backend drain before stopping it
+        while time.monotonic() - max(dec.last, start) < 1:
+            time.sleep(0.1)
+        dec.stop()
+        cpu = _cpu_time() - cpu
+        print(f"{name}: {len(frames)} frames in, {dec.count} PNGs out, {cpu * 1000 / len(frames):.2f} ms CPU/frame, {cpu * 1000 / max(dec.count, 1):.2f} ms CPU/PNG")
+        if dec.sps is not None and cpu > 0:
+            # Leave half a core for USB, the web server and the phone raising its frame rate
+            budget = 0.5 * dec.sps.width * dec.sps.height * len(frames) / cpu
+            print(f"{name}: suggested `teslabox.py --decode-budget {budget:.0f}` (pixels per second)")
+
+def _protocol_samples(protocol):
+    """A randomly populated instance of every message type, and of every Switch and Optional branch."""
+    rand = lambda: random.randrange(1 << 32)
+    text = lambda n: "".join(random.choice("0123456789abcdef") for _ in range(n))
+    samples = []
+    for cls in sorted(protocol.Message._allmessages().values(), key=lambda x: x.msgtype):
+        msg = cls()
+        for segment in cls.schema.segments:
+            for name in segment.names:
+                value = getattr(msg, name)
+                if isinstance(value, bool):
+                    setattr(msg, name, True)
+                elif isinstance(value, float):
+                    setattr(msg, name, 0.5)
+                elif isinstance(value, str):
+                    setattr(msg, name, text(len(value) or 8))
+                elif isinstance(value, bytes):
+                    setattr(msg, name, random.randbytes(random.randrange(1, 4096)))
+                elif isinstance(value, int) and not hasattr(value, "name"):
+                    setattr(msg, name, rand())
+        if isinstance(msg, protocol.AudioData):
+            msg.data = random.randbytes(1024)
+            for name in ("command", "volumeDuration"):
+                other = protocol.AudioData()
+                other.decodeType = 5
+                other.volume = 0.25
+                setattr(other, name, protocol.AudioData.Command.AUDIO_SIRI_START if name == "command" else rand())
+                samples.append(other)
+        elif isinstance(msg, protocol.Plugged):
+            msg.wifistyle = msg.wifi = False # wifi isn't sent without wifistyle
+            other = protocol.Plugged(wifistyle=True)
+            other.phone_type = 3
+            other.wifi = True
+            samples.append(other)
+        elif isinstance(msg, protocol.MultiTouch):
+            for i in range(3):
+                touch = protocol.MultiTouch.Touch()
+                touch.x = touch.y = i / 4
+                touch.id = i
+                msg.touches.append(touch)
+        samples.append(msg)
+    return samples
+
+def _fields(msg):
+    # Compare types too, as True == 1 and an IntEnum equals its value
+    return {k: [_fields(x) for x in v] if isinstance(v, list) else (type(v), v) for k, v in vars(msg).items()}
+
+# The hand-written codecs protocol.py used before bodies were described with protocol.Schema
+class _LegacyOpen:
+    def __init__(self, opened):
+        self.__dict__.update(vars(opened))
+
+    def serialise(self):
+        data = self._data()
+        return struct.pack("<LLLL", 0x55aa55aa, len(data), self.type, (self.type ^ -1) & 0xffffffff) + data
+
+    def _data(self):
+        return struct.pack("<LLLLLLL", self.width, self.height, self.videoFrameRate, self.format, self.packetMax, self.iBoxVersion, self.phoneWorkMode)
+
+class _LegacyVideoData:
+    def _setdata(self, data):
+        (self.width, self.height, self.flags, self.unknown1, self.unknown2) = struct.unpack("<LLLLL", data[:20])
+        self.data = data[20:]
+
+def _legacy_videodata(protocol, data):
+    (magic, datalen, type, typecheck) = struct.unpack("<LLLL", data[:16])
+    if typecheck != (type ^ -1) & 0xffffffff or magic != 0x55aa55aa:
+        raise ValueError("Bad header")
+    protocol.Message._allmessages()[type] # the lookup Message.upgrade made for every message
+    msg = _LegacyVideoData()
+    msg._setdata(data[16:])
+    return msg
+
+def bench_protocol(args):
+    import protocol
+    for msg in _protocol_samples(protocol):
+        data = msg.serialise()
+        if type(data) is not bytes:
+            raise AssertionError(f"{type(msg).__name__} serialised to {type(data).__name__}")
+        back = protocol.Message.unpack_from(data)
+        if type(back) is not type(msg) or _fields(back) != _fields(msg):
+            raise AssertionError(f"{type(msg).__name__} failed to round-trip")
+    print("All message types round-trip")
+    opened = protocol.Open()
+    video = protocol.VideoData()
+    video.data = random.randbytes(args.size)
+    videodata = video.serialise()
+    shared = bytearray(65536)
+    cases = [
+        ("Open serialise (legacy)", _LegacyOpen(opened).serialise),
+        ("Open serialise", opened.serialise),
+        ("Open pack_into", functools.partial(opened.pack_into, shared)),
+        ("VideoData parse (legacy)", lambda: _legacy_videodata(protocol, videodata)),
+        ("VideoData unpack_from", lambda: protocol.Message.unpack_from(videodata)),
+    ]
+    for (name, func) in cases:
+        seconds = min(timeit.repeat(func, number=args.count, repeat=3))
+        print(f"{name}: {seconds * 1e6 / args.count:.2f} us")
+
+def bench_usb(args):
+    import link
+    import protocol
+    import threading
+    for pipeline in args.pipeline or [0, 2, 4, 8]:
+        device = link.FakeDevice(latency=args.latency, bandwidth=args.bandwidth)
+        for i in range(args.count):
+            msg = protocol.VideoData()
+            msg.data = random.randbytes(args.size)
+            device.inject_message(msg)
+        done = threading.Event()
+        class _Counter(link.Connection):
+            count = 0
+            def on_message(self, message):
+                self.count += 1
+                if self.count == args.count:
+                    done.set()
+        cpu = _cpu_time()
+        start = time.monotonic()
+        conn = _Counter(device=device, pipeline=pipeline)
+        done.wait()
+        elapsed = time.monotonic() - start
+        cpu = _cpu_time() - cpu
+        conn.stop()
+        print(f"pipeline={pipeline}: {args.count / elapsed:.0f} messages/s, {args.count * args.size / elapsed / 1e6:.1f} MB/s, {cpu * 1e6 / args.count:.0f} us CPU/message")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    cmd = commands.add_parser("decoder", help="CPU per frame for each decoder backend")
+    cmd.add_argument("file", help="raw h264 (Annex B) file, e.g. captured VideoData")
+    cmd.add_argument("--backend", action="append", choices=sorted(decoder.backends), help="backend to test (default: all)")
+    cmd.add_argument("--rate", type=float, default=30, help="frames per second to feed")
+    cmd.set_defaults(func=bench_decoder)
+    cmd = commands.add_parser("protocol", help="check every message round-trips, then time the codecs")
+    cmd.add_argument("--count", type=int, default=100000, help="iterations per case")
+    cmd.add_argument("--size", type=int, default=32768, help="VideoData payload bytes")
+    cmd.set_defaults(func=bench_protocol)
+    cmd = commands.add_parser("usb", help="message throughput over a fake device, synchronous vs pipelined reads")
+    cmd.add_argument("--pipeline", type=int, action="append", help="transfers in flight, 0 for synchronous (default: 0, 2, 4, 8)")
+    cmd.add_argument("--latency", type=float, default=0.0005, help="fake transfer turnaround latency (seconds)")
+    cmd.add_argument("--bandwidth", type=float, default=35e6, help="fake bus bandwidth (bytes per second)")
+    cmd.add_argument("--count", type=int, default=2000, help="VideoData messages to read")
+    cmd.add_argument("--size", type=int, default=16384, help="VideoData payload bytes")
+    cmd.set_defaults(func=bench_usb)
+    args = parser.parse_args()
+    args.func(args)
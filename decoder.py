@@ -1,18 +1,41 @@
-
 # "Autobox" dongle driver for HTML 'streaming'
 # Created by Colin Munro, December 2019
 # See README.md for more information
 
 """Simple utility code to decode an h264 stream to a series of PNGs."""
 
-import subprocess, threading, os, fcntl
+import subprocess, threading, os, fcntl, time
+from queue import Queue, Empty, Full
+import h264
+import profiler
+
+class Backend:
+	"""Base decoder implementation; takes h264 via send() and passes PNGs to owner.on_frame()."""
+
+	def __init__(self, owner):
+		self.owner = owner
+
+	def send(self, data):
+		raise NotImplementedError
+
+	def stop(self):
+		pass
+
+	def _output(self, png):
+		# A backend replaced after a resize may still be flushing in the background; its frames are out of date
+		if self.owner.backend is self:
+			self.owner.on_frame(png)
+
+class FFmpegProcess(Backend):
+	"""Decodes in an `ffmpeg` subprocess, communicating via pipes."""
+	stop_timeout = 5 # seconds to wait for ffmpeg to exit before killing it
 
-class Decoder:
 	class _Thread(threading.Thread):
 		def __init__(self, owner):
 			super().__init__()
 			self.owner = owner
 			self.running = threading.Event()
+			profiler.register(self, "decoder-output")
 			self.shutdown = False
 
 		def run(self):
@@ -23,7 +46,10 @@ class Decoder:
 				data = self.owner.child.stdout.read(1024000)
 				if data is None or not len(data):
 					self.running.clear()
-					self.running.wait(timeout=0.1)
+					if self.owner.owner.active:
+						self.running.wait(timeout=0.1)
+					else:
+						self.running.wait()
 					continue
 				captured_data += data
 				first_header = captured_data.find(png_header)
@@ -39,10 +65,13 @@ class Decoder:
 					png = captured_data[:second_header]
 					captured_data = captured_data[second_header:]
 					checked = len(png_header)
-					self.owner.on_frame(png)
+					self.owner._output(png)
 
-	def __init__(self):
-		self.child = subprocess.Popen(["ffmpeg", "-threads", "4", "-i", "-", "-vf", "fps=7", "-c:v", "png", "-f", "image2pipe", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1)
+	def __init__(self, owner):
+		super().__init__(owner)
+		# Raw h264 has no timestamps, so stamp frames as they arrive for the fps filter to follow the real rate
+		limit = ["-vf", f"fps={owner.fps}"] if owner.fps else []
+		self.child = subprocess.Popen(["ffmpeg", "-threads", "4", "-use_wallclock_as_timestamps", "1", "-i", "-"] + limit + ["-c:v", "png", "-f", "image2pipe", "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=1)
 		fd = self.child.stdout.fileno()
 		fl = fcntl.fcntl(fd, fcntl.F_GETFL)
 		fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
@@ -50,15 +79,195 @@ class Decoder:
 		self.thread.start()
 
 	def stop(self):
-		self.child.terminate()
 		self.thread.shutdown = True
+		self.thread.running.set()
 		self.thread.join()
+		# At the end of its input ffmpeg flushes what it has buffered and exits, but only if its output is drained
+		try:
+			self.child.communicate(timeout=self.stop_timeout)
+		except subprocess.TimeoutExpired:
+			self.child.kill()
+			self.child.communicate()
 
 	def send(self, data):
 		self.child.stdin.write(data)
 		self.child.stdin.flush()
 		self.thread.running.set()
 
+class PyAV(Backend):
+	"""Decodes in-process with libav (via PyAV); PNGs are handed over as buffers without copying."""
+	queue_limit = 60 # access units waiting to be decoded, beyond which input is dropped up to the next IDR
+
+	class _Thread(threading.Thread):
+		def __init__(self, owner):
+			super().__init__()
+			self.owner = owner
+			self.queue = Queue(owner.queue_limit)
+			profiler.register(self, "decoder")
+
+		def run(self):
+			while True:
+				try:
+					data = self.queue.get(timeout=self.owner._flush_timeout())
+				except Empty:
+					data = b''
+				if data is None:
+					break
+				if data and self.owner._resync:
+					if not any(x.type == h264.NALType.IDR for x in h264.units(data)):
+						continue
+					self.owner._resync = False
+				try:
+					if data:
+						self.owner._decode(data)
+					else:
+						self.owner._flush()
+				except self.owner._av.error.FFmpegError:
+					self.owner._resync = True # e.g. corrupt data: start again from the next IDR
+
+	def __init__(self, owner):
+		super().__init__(owner)
+		import av
+		self._av = av
+		self._codec = av.CodecContext.create("h264", "r")
+		self._png = None
+		self._next = 0
+		self._pending = None
+		self._resync = False
+		self.thread = self._Thread(self)
+		self.thread.start()
+
+	def stop(self):
+		self.thread.queue.put(None)
+		self.thread.join()
+
+	def send(self, data):
+		# Unlike a pipe to ffmpeg, nothing pushes back here, so don't let latency build up when decoding is too slow
+		try:
+			self.thread.queue.put_nowait(bytes(data))
+		except Full:
+			self._resync = True
+
+	def _encoder(self, frame):
+		if self._png is None or self._png.width != frame.width or self._png.height != frame.height:
+			self._png = self._av.CodecContext.create("png", "w")
+			self._png.width = frame.width
+			self._png.height = frame.height
+			self._png.pix_fmt = "rgb24"
+		return self._png
+
+	def _flush_timeout(self):
+		return None if self._pending is None else max(self._next - time.monotonic(), 0)
+
+	def _flush(self):
+		(frame, self._pending) = (self._pending, None)
+		now = time.monotonic()
+		# Keep to a steady cadence, unless so far behind (e.g. after a pause) that it would mean a burst
+		interval = 1 / self.owner.fps if self.owner.fps else 0
+		self._next = self._next + interval if self._next + interval > now else now + interval
+		for png in self._encoder(frame).encode(frame.reformat(format="rgb24")):
+			self._output(memoryview(png))
+
+	def _decode(self, data):
+		for packet in self._codec.parse(data):
+			for frame in self._codec.decode(packet):
+				if not self.owner.active:
+					continue # still in flight from before decoding was suspended
+				# Like ffmpeg's fps filter, don't encode frames nobody will see; but do keep the newest, to show once
+				# the interval is up, so the end of a burst (e.g. a replayed GOP) isn't lost
+				self._pending = frame
+				if time.monotonic() >= self._next:
+					self._flush()
+
+backends = {
+	"ffmpeg": FFmpegProcess,
+	"pyav": PyAV,
+}
+
+default_backend = "ffmpeg"
+
+class Decoder:
+	fps = 7 # PNGs generated per second, or None for every frame
+	idle_timeout = 5 # seconds without demand() before decoding is suspended
+	gop_limit = 4 * 1024 * 1024 # bytes of the current GOP kept for a fast resume
+	keyframe_retry = 2 # seconds between keyframe requests while waiting to resume
+
+	def __init__(self, backend=None):
+		self._backend = backend or default_backend
+		self.sps = None
+		self._last_demand = 0
+		self._parameter_sets = {}
+		self._gop = None
+		self._gop_size = 0
+		self._synced = False
+		self._keyframe_requested = 0
+		self.backend = backends[self._backend](self)
+
+	def stop(self):
+		self.backend.stop()
+
+	@property
+	def active(self):
+		return time.monotonic() - self._last_demand < self.idle_timeout
+
+	def demand(self):
+		"""Note that a consumer wants frames; decoding resumes if it was suspended."""
+		self._last_demand = time.monotonic()
+
+	def send(self, data):
+		idr = False
+		resized = False
+		for unit in h264.units(data):
+			if unit.type == h264.NALType.SPS:
+				self._parameter_sets[unit.type] = unit.raw()
+				try:
+					sps = h264.SPS(unit.rbsp())
+				except ValueError:
+					continue
+				resized = self.sps is not None and (sps.width, sps.height) != (self.sps.width, self.sps.height)
+				self.sps = sps
+			elif unit.type == h264.NALType.PPS:
+				self._parameter_sets[unit.type] = unit.raw()
+			elif unit.type == h264.NALType.IDR:
+				idr = True
+		# Keep everything since the last IDR, so a returning viewer doesn't wait for the next one
+		if idr:
+			self._gop = []
+			self._gop_size = 0
+		if self._gop is not None:
+			self._gop.append(data)
+			self._gop_size += len(data)
+			if self._gop_size > self.gop_limit:
+				self._gop = None # too much to replay quickly; resuming will need the next IDR
+		# The phone changed resolution (e.g. after a new Open): start afresh rather than rely on the backend adapting
+		if resized:
+			# Stopping a backend waits for it to finish, so don't hold up the caller (the USB reader) with that
+			(old, self.backend) = (self.backend, backends[self._backend](self))
+			profiler.register(threading.Thread(target=old.stop, daemon=True), "decoder-stop").start()
+			self._synced = False
+			if not idr:
+				self._gop = None
+		if not self.active:
+			self._synced = False
+			return
+		if not self._synced:
+			if self._gop is None:
+				# Nothing to catch up from, so ask for an IDR rather than wait for the phone to send one
+				now = time.monotonic()
+				if now - self._keyframe_requested > self.keyframe_retry:
+					self._keyframe_requested = now
+					self.on_keyframe_needed()
+				return
+			self._synced = True
+			self._keyframe_requested = 0
+			parameter_sets = [] if any(x.type == h264.NALType.SPS for x in h264.units(self._gop[0])) else [self._parameter_sets[x] for x in (h264.NALType.SPS, h264.NALType.PPS) if x in self._parameter_sets]
+			data = b''.join(parameter_sets + self._gop)
+		self.backend.send(data)
+
 	def on_frame(self, png):
-		"""Callback for when a frame is received [called from a worker thread]."""
+		"""Callback for when a frame is received, as bytes or a buffer object [called from a worker thread]."""
+		pass
+
+	def on_keyframe_needed(self):
+		"""Callback for when decoding can't resume until the next IDR, so one should be requested [called from send()]."""
 		pass
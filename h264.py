@@ -0,0 +1,192 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Lightweight H.264 Annex B parser: start codes, NAL unit types and SPS geometry."""
+
+from enum import IntEnum
+
+class NALType(IntEnum):
+    Slice = 1
+    SliceA = 2
+    SliceB = 3
+    SliceC = 4
+    IDR = 5
+    SEI = 6
+    SPS = 7
+    PPS = 8
+    AUD = 9
+    EndOfSequence = 10
+    EndOfStream = 11
+    Filler = 12
+
+_vcl_types = frozenset(range(NALType.Slice, NALType.IDR + 1))
+
+def _setenum(enum, val):
+    try:
+        return enum(val)
+    except ValueError:
+        return val
+
+def start_codes(data, start=0):
+    """Yield (code_offset, payload_offset) for each 3 or 4 byte start code in data."""
+    find = data.find
+    pos = find(b'\0\0\1', start)
+    while pos != -1:
+        if pos > start and data[pos - 1] == 0:
+            yield (pos - 1, pos + 3)
+        else:
+            yield (pos, pos + 3)
+        pos = find(b'\0\0\1', pos + 3)
+
+class NALUnit:
+    """A single NAL unit within a buffer; `start` is the start code position, `payload` the header byte position."""
+
+    def __init__(self, data, start, payload, end):
+        self.buffer = data
+        self.start = start
+        self.payload = payload
+        self.end = end
+        self.type = _setenum(NALType, data[payload] & 0x1f) if payload < end else 0
+        self.ref_idc = (data[payload] >> 5) & 3 if payload < end else 0
+
+    @property
+    def is_vcl(self):
+        return self.type in _vcl_types
+
+    @property
+    def first_slice(self):
+        """True if this VCL unit begins a new picture (first_mb_in_slice == 0, a single '1' bit in exp-Golomb)."""
+        return self.is_vcl and self.payload + 1 < self.end and bool(self.buffer[self.payload + 1] & 0x80)
+
+    def raw(self):
+        """The unit including its start code."""
+        return bytes(self.buffer[self.start:self.end])
+
+    def rbsp(self):
+        """The unit payload after the header byte, with emulation prevention bytes removed."""
+        return bytes(self.buffer[self.payload + 1:self.end]).replace(b'\0\0\3', b'\0\0')
+
+def units(data):
+    """Split an Annex B buffer into NAL units (any bytes before the first start code are ignored)."""
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    found = list(start_codes(data))
+    result = []
+    for i, (start, payload) in enumerate(found):
+        end = found[i + 1][0] if i + 1 < len(found) else len(data)
+        result.append(NALUnit(data, start, payload, end))
+    return result
+
+def access_units(data):
+    """Split an Annex B stream into access units, each returned as bytes (parameter sets travel with their picture)."""
+    if not isinstance(data, (bytes, bytearray)):
+        data = bytes(data)
+    result = []
+    current = None
+    seen_vcl = False
+    for unit in units(data):
+        if unit.is_vcl:
+            new = seen_vcl and unit.first_slice
+            seen_vcl = True
+        else:
+            new = seen_vcl and unit.type in (NALType.AUD, NALType.SPS, NALType.PPS, NALType.SEI)
+            if new:
+                seen_vcl = False
+        if current is None or new:
+            if current is not None:
+                result.append(bytes(data[current:unit.start]))
+            current = unit.start
+    if current is not None:
+        result.append(bytes(data[current:]))
+    return result
+
+class _BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def bit(self):
+        byte = self.data[self.pos >> 3]
+        value = (byte >> (7 - (self.pos & 7))) & 1
+        self.pos += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        zeros = 0
+        while not self.bit():
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("Invalid exp-Golomb code")
+        return (1 << zeros) - 1 + self.bits(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+def _skip_scaling_list(reader, size):
+    last = 8
+    following = 8
+    for _ in range(size):
+        if following:
+            following = (last + reader.se() + 256) % 256
+        last = following or last
+
+class SPS:
+    """Sequence parameter set fields needed to know the picture geometry."""
+
+    def __init__(self, rbsp):
+        reader = _BitReader(rbsp)
+        try:
+            self._parse(reader)
+        except IndexError:
+            raise ValueError("Truncated SPS")
+
+    def _parse(self, reader):
+        self.profile_idc = reader.bits(8)
+        reader.bits(8) # constraint flags
+        self.level_idc = reader.bits(8)
+        self.id = reader.ue()
+        chroma_format_idc = 1
+        if self.profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+            chroma_format_idc = reader.ue()
+            if chroma_format_idc == 3:
+                reader.bit() # separate_colour_plane_flag
+            reader.ue() # bit_depth_luma_minus8
+            reader.ue() # bit_depth_chroma_minus8
+            reader.bit() # qpprime_y_zero_transform_bypass_flag
+            if reader.bit(): # seq_scaling_matrix_present_flag
+                for i in range(8 if chroma_format_idc != 3 else 12):
+                    if reader.bit():
+                        _skip_scaling_list(reader, 16 if i < 6 else 64)
+        reader.ue() # log2_max_frame_num_minus4
+        poc_type = reader.ue()
+        if poc_type == 0:
+            reader.ue() # log2_max_pic_order_cnt_lsb_minus4
+        elif poc_type == 1:
+            reader.bit()
+            reader.se()
+            reader.se()
+            for _ in range(reader.ue()):
+                reader.se()
+        reader.ue() # max_num_ref_frames
+        reader.bit() # gaps_in_frame_num_value_allowed_flag
+        mbs_width = reader.ue() + 1
+        map_units_height = reader.ue() + 1
+        frame_mbs_only = reader.bit()
+        if not frame_mbs_only:
+            reader.bit() # mb_adaptive_frame_field_flag
+        reader.bit() # direct_8x8_inference_flag
+        crop = (0, 0, 0, 0)
+        if reader.bit():
+            crop = (reader.ue(), reader.ue(), reader.ue(), reader.ue())
+        crop_x = 1 if chroma_format_idc in (0, 3) else 2
+        crop_y = (1 if chroma_format_idc in (0, 2, 3) else 2) * (2 - frame_mbs_only)
+        self.width = mbs_width * 16 - crop_x * (crop[0] + crop[1])
+        self.height = (2 - frame_mbs_only) * map_units_height * 16 - crop_y * (crop[2] + crop[3])
@@ -1,4 +1,3 @@
-
 # "Autobox" dongle driver for HTML 'streaming'
 # Created by Colin Munro, December 2019
 # See README.md for more information
@@ -8,14 +7,21 @@
 import usb.core
 import usb.util
 import threading
+import time
+from collections import deque
 import protocol
+import profiler
 
-class Connection:
-    idVendor = 0x1314
-    idProduct = 0x1520
-    
-    def __init__(self):
-        self._device = usb.core.find(idVendor = self.idVendor, idProduct = self.idProduct)
+Error = usb.core.USBError
+
+def _timeout():
+    return Error("Operation timed out", errno=110)
+
+class PyUSBDevice:
+    """Synchronous access to the dongle via pyusb: one transfer at a time."""
+
+    def __init__(self, idVendor, idProduct):
+        self._device = usb.core.find(idVendor = idVendor, idProduct = idProduct)
         if self._device is None:
             raise RuntimeError("Couldn't find USB device")
         self._device.reset()
@@ -29,18 +35,252 @@ class Connection:
         if self._ep_out is None:
             raise RuntimeError("Couldn't find output endpoint")
         self._ep_out.clear_halt()
+
+    def read(self, size):
+        return self._ep_in.read(size)
+
+    def write(self, data):
+        self._ep_out.write(data)
+
+    def close(self):
+        usb.util.dispose_resources(self._device)
+
+class LibUSB1Device:
+    """Access to the dongle via python-libusb1, which (unlike pyusb) can keep several IN transfers in flight."""
+
+    def __init__(self, idVendor, idProduct):
+        import usb1
+        self._usb1 = usb1
+        self._context = usb1.USBContext()
+        self._handle = self._open(idVendor, idProduct)
+        # Start from a clean state, as PyUSBDevice does
+        try:
+            self._handle.resetDevice()
+        except usb1.USBErrorNotFound:
+            # The device re-enumerated, which invalidates the handle
+            self._handle.close()
+            self._handle = self._open(idVendor, idProduct)
+        try:
+            self._handle.setAutoDetachKernelDriver(True)
+        except usb1.USBErrorNotSupported:
+            pass
+        self._handle.setConfiguration(next(iter(self._handle.getDevice())).getConfigurationValue())
+        self._handle.claimInterface(0)
+        self._ep_in = self._ep_out = None
+        for setting in self._handle.getDevice().iterSettings():
+            if setting.getNumber() != 0 or setting.getAlternateSetting() != 0:
+                continue
+            for endpoint in setting:
+                if endpoint.getAddress() & usb1.ENDPOINT_DIR_MASK == usb1.ENDPOINT_IN:
+                    self._ep_in = endpoint.getAddress()
+                else:
+                    self._ep_out = endpoint.getAddress()
+        if self._ep_in is None:
+            raise RuntimeError("Couldn't find input endpoint")
+        if self._ep_out is None:
+            raise RuntimeError("Couldn't find output endpoint")
+        self._handle.clearHalt(self._ep_in)
+        self._handle.clearHalt(self._ep_out)
+        self._transfers = {}
+
+    def _open(self, idVendor, idProduct):
+        handle = self._context.openByVendorIDAndProductID(idVendor, idProduct)
+        if handle is None:
+            raise RuntimeError("Couldn't find USB device")
+        return handle
+
+    def read(self, size):
+        try:
+            return self._handle.bulkRead(self._ep_in, size, timeout=1000)
+        except self._usb1.USBErrorTimeout:
+            raise _timeout()
+        except self._usb1.USBError as e:
+            raise Error(str(e))
+
+    def write(self, data):
+        try:
+            self._handle.bulkWrite(self._ep_out, data, timeout=1000)
+        except self._usb1.USBError as e:
+            raise Error(str(e))
+
+    def submit(self, buffer, callback):
+        """Queue an IN transfer into buffer; callback(length, error) is called from handle_events() when it completes."""
+        transfer = self._transfers.get(id(buffer))
+        if transfer is None:
+            transfer = self._handle.getTransfer()
+            transfer.setBulk(self._ep_in, buffer, callback=self._completed, user_data=callback)
+            self._transfers[id(buffer)] = transfer
+        transfer.submit()
+
+    def _completed(self, transfer):
+        status = transfer.getStatus()
+        if status == self._usb1.TRANSFER_CANCELLED:
+            return
+        if status == self._usb1.TRANSFER_COMPLETED:
+            transfer.getUserData()(transfer.getActualLength(), None)
+        else:
+            transfer.getUserData()(0, Error(f"Transfer failed ({status})"))
+
+    def handle_events(self, timeout):
+        self._context.handleEventsTimeout(tv=timeout)
+
+    def cancel(self):
+        for transfer in self._transfers.values():
+            if transfer.isSubmitted():
+                try:
+                    transfer.cancel()
+                except self._usb1.USBError:
+                    pass
+        while any(x.isSubmitted() for x in self._transfers.values()):
+            self._context.handleEventsTimeout(tv=0.1)
+
+    def close(self):
+        self._handle.releaseInterface(0)
+        self._handle.close()
+        self._context.close()
+
+class FakeDevice:
+    """Software stand-in for the dongle, for testing and benchmarking without hardware. Every transfer has a fixed
+        `latency` (turnaround, which queued transfers overlap) and then occupies the bus, one transfer at a time, for
+        its length at `bandwidth` bytes per second."""
+
+    def __init__(self, latency=0.0005, bandwidth=35e6):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.written = []
+        self._lock = threading.Condition()
+        self._data = deque() # IN transfers waiting to be read, as [arrival time, data]
+        self._pending = deque() # submitted IN transfers, as (submission time, buffer, callback)
+        self._bus_free = 0 # when the transfer currently on the bus completes
+
+    def inject(self, data):
+        """Queue data to be returned by a single IN transfer."""
+        with self._lock:
+            self._data.append([time.monotonic(), bytes(data)])
+            self._lock.notify_all()
+
+    def inject_message(self, message):
+        """Queue a message, as the dongle sends it: header and body in separate transfers."""
+        data = message.serialise()
+        self.inject(data[:message.headersize])
+        if len(data) > message.headersize:
+            self.inject(data[message.headersize:])
+
+    def _next(self, size):
+        (arrival, data) = self._data[0]
+        if len(data) <= size:
+            self._data.popleft()
+            return data
+        self._data[0][1] = data[size:]
+        return data[:size]
+
+    def read(self, size):
+        deadline = time.monotonic() + 1
+        time.sleep(self.latency)
+        with self._lock:
+            while not self._data:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise _timeout()
+                self._lock.wait(remaining)
+            data = self._next(size)
+        time.sleep(len(data) / self.bandwidth)
+        return data
+
+    def write(self, data):
+        time.sleep(self.latency + len(data) / self.bandwidth)
+        with self._lock:
+            self.written.append(bytes(data))
+        self.on_write(data)
+
+    def on_write(self, data):
+        """Callback for data sent to the device, e.g. to inject a reply [called from the writing thread]."""
+        pass
+
+    def submit(self, buffer, callback):
+        with self._lock:
+            self._pending.append((time.monotonic(), buffer, callback))
+            self._lock.notify_all()
+
+    def _due(self):
+        """When the first pending transfer completes: it starts once turned around, once there's data for it and once
+            the bus is free."""
+        (submitted, buffer, callback) = self._pending[0]
+        (arrival, data) = self._data[0]
+        return max(submitted + self.latency, arrival, self._bus_free) + min(len(buffer), len(data)) / self.bandwidth
+
+    def handle_events(self, timeout):
+        deadline = time.monotonic() + timeout
+        completed = []
+        with self._lock:
+            while not completed:
+                now = time.monotonic()
+                while self._pending and self._data:
+                    due = self._due()
+                    if due > now:
+                        break
+                    (submitted, buffer, callback) = self._pending.popleft()
+                    data = self._next(len(buffer))
+                    buffer[:len(data)] = data
+                    completed.append((callback, len(data)))
+                    self._bus_free = due
+                if completed or now >= deadline:
+                    break
+                wait = deadline - now
+                if self._pending and self._data:
+                    wait = min(wait, self._due() - now)
+                self._lock.wait(wait)
+        for (callback, length) in completed:
+            callback(length, None)
+
+    def cancel(self):
+        with self._lock:
+            self._pending.clear()
+
+    def close(self):
+        pass
+
+class Connection:
+    idVendor = 0x1314
+    idProduct = 0x1520
+    transfer_size = 65536 # bytes per pipelined IN transfer; more than the largest message (Open.packetMax)
+
+    class _Transfer:
+        def __init__(self, size):
+            self.buffer = bytearray(size)
+            self.done = False
+            self.length = 0
+            self.error = None
+
+        def completed(self, length, error):
+            self.length = length
+            self.error = error
+            self.done = True
+
+    def __init__(self, device=None, pipeline=0):
+        """`pipeline` is the number of IN transfers to keep in flight; 0 reads synchronously, one at a time."""
+        if device is None:
+            device = (LibUSB1Device if pipeline else PyUSBDevice)(self.idVendor, self.idProduct)
+        self._device = device
+        self._pipeline = pipeline
         self._out_locker = threading.Lock()
+        self._out_buffer = bytearray()
         self._run = True
-        self._thread = threading.Thread(target=self._read_thread)
+        self._thread = profiler.register(threading.Thread(target=self._pipeline_thread if pipeline else self._read_thread), "usb-reader")
         self._thread.start()
 
     def send_message(self, message):
-        data = message.serialise()
+        size = message.size()
         while not self._out_locker.acquire():
             pass
         try:
-            self._ep_out.write(data[:message.headersize])
-            self._ep_out.write(data[message.headersize:])
+            # Serialise into a buffer reused between messages, and write header and body without copying them out
+            if len(self._out_buffer) < size:
+                self._out_buffer = bytearray(size)
+            message.pack_into(self._out_buffer)
+            with memoryview(self._out_buffer) as view:
+                self._device.write(view[:message.headersize])
+                self._device.write(view[message.headersize:size])
         finally:
             self._out_locker.release()
 
@@ -49,8 +289,10 @@ class Connection:
             self.send_message(x)
 
     def stop(self):
+        """Stop reading and release the device; safe to call from on_message() or on_error()."""
         self._run = False
-        self._thread.join()
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
 
     def on_message(self, message):
         """Handle message from dongle [called from another thread]"""
@@ -60,32 +302,67 @@ class Connection:
         """Handle exception on dongle read thread [called from another thread]"""
         self._run = False
 
+    def _fail(self, error):
+        self._run = False # the device is unusable, so the read thread exits and releases it
+        self.on_error(error)
+
+    def _dispatch(self, msg):
+        try:
+            self.on_message(msg)
+        except Exception as e:
+            self.on_error(e)
+
     def _read_thread(self):
+        try:
+            self._read_loop()
+        finally:
+            self._device.close()
+
+    def _read_loop(self):
         while self._run:
             try:
-                data = self._ep_in.read(protocol.Message.headersize)
+                data = self._device.read(protocol.Message.headersize)
             except usb.core.USBError as e:
                 if e.errno != 110: # Timeout
-                    self.on_error(e)
+                    self._fail(e)
                 continue
             if len(data) == protocol.Message.headersize:
-                header = protocol.Message()
-                header.deserialise(data)
-                needlen = len(header._data())
+                (msgtype, needlen) = protocol.Message.unpack_header(data)
+                header = protocol.Message(msgtype)
                 if needlen:
                     try:
-                        msg = header.upgrade(self._ep_in.read(needlen))
+                        msg = header.upgrade(self._device.read(needlen))
                     except usb.core.USBError as e:
-                        self._threaderror(e)
+                        self._fail(e)
                         continue
                 else:
-                    msg = header
-                try:
-                    self.on_message(msg)
-                except Exception as e:
-                    self.on_error(e)
-                    continue
+                    msg = header.upgrade(b'')
+                self._dispatch(msg)
             else:
                 print(f"R> Bad data: {data}")
 
-Error = usb.core.USBError
+    def _pipeline_thread(self):
+        """Keep several IN transfers queued so the bus is never idle waiting for Python, and parse their data in order."""
+        parser = protocol.Parser()
+        inflight = deque()
+        try:
+            for _ in range(self._pipeline):
+                transfer = self._Transfer(self.transfer_size)
+                self._device.submit(transfer.buffer, transfer.completed)
+                inflight.append(transfer)
+            while self._run:
+                self._device.handle_events(0.1)
+                while self._run and inflight and inflight[0].done:
+                    transfer = inflight.popleft()
+                    if transfer.error is not None:
+                        self._fail(transfer.error)
+                        break
+                    messages = parser.feed(memoryview(transfer.buffer)[:transfer.length])
+                    transfer.done = False
+                    self._device.submit(transfer.buffer, transfer.completed)
+                    inflight.append(transfer)
+                    for msg in messages:
+                        self._dispatch(msg)
+        finally:
+            self._device.cancel()
+            self._device.close()
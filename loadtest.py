@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+# "Autobox" dongle driver for HTML 'streaming' - load test
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Load test: drive Teslabox from a replayed h264 file instead of a dongle, with simulated browsers polling
+    /snapshot or reading /stream and sending /touch, then report frame age and touch latency against SLOs."""
+import argparse
+import bisect
+import http.client
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import zlib
+import simplejson
+import decoder
+import h264
+import profiler
+import protocol
+import teslabox
+
+class _FakeConnection(teslabox.Teslabox._Connection):
+    """Stands in for the dongle: acknowledges Open, then replays the feed as VideoData."""
+
+    def __init__(self, owner):
+        self._owner = owner
+        self._run = True
+        self._thread = profiler.register(threading.Thread(target=self._feed_thread, daemon=True), "fake-dongle")
+
+    def send_message(self, message):
+        if isinstance(message, protocol.Open) and not self._thread.is_alive():
+            self.on_message(message)
+            self._thread.start()
+
+    def stop(self):
+        self._run = False
+        self._thread.join()
+
+    def _feed_thread(self):
+        owner = self._owner
+        start = time.monotonic()
+        i = 0
+        while self._run:
+            msg = protocol.VideoData()
+            msg.data = owner.feed[i % len(owner.feed)]
+            owner.injected[i % len(owner.feed)].append(time.monotonic())
+            i += 1
+            if owner.stream:
+                owner.sent_bytes += len(msg.data)
+                owner.sent_times.append((owner.sent_bytes, time.monotonic()))
+                owner.server.send_stream(msg.data)
+            self.on_message(msg)
+            delay = start + i / owner.fps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+class _LoadBox(teslabox.Teslabox):
+    _Connection = _FakeConnection
+
+    class _Decoder(teslabox.Teslabox._Decoder):
+        def on_frame(self, png):
+            super().on_frame(png)
+            self._owner.frame_times[zlib.crc32(png)] = time.monotonic()
+
+    def __init__(self, feed, frame_indices, fps, stream, **kwargs):
+        self.feed = feed
+        self.frame_indices = frame_indices
+        self.injected = [[] for _ in feed]
+        self.fps = fps
+        self.stream = stream
+        self.frame_times = {}
+        self.sent_bytes = 0
+        self.sent_times = []
+        super().__init__(**kwargs)
+
+class _Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frame_age = []
+        self.touch = []
+        self.errors = 0
+
+    def add(self, name, value):
+        with self.lock:
+            getattr(self, name).append(value)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+def _frame_indices(feed, backend):
+    """Decode the whole feed once, keeping every frame, to map each PNG (by CRC) to the access units it comes from.
+        Assumes one frame per access unit, output in decoding order (no B-frames), as with a phone's stream."""
+    pngs = []
+    class _Reference(decoder.Decoder):
+        fps = None
+        idle_timeout = float("inf")
+        def on_frame(self, png):
+            pngs.append(zlib.crc32(png))
+    dec = _Reference(backend)
+    dec.demand()
+    # Keep well inside the pyav backend's queue, which drops input (and so frames) once it's full
+    window = decoder.PyAV.queue_limit // 2
+    for (sent, x) in enumerate(feed):
+        deadline = time.monotonic() + 1 # don't wait forever on an access unit that produces no frame
+        while sent - len(pngs) > window and time.monotonic() < deadline:
+            time.sleep(0.01)
+        dec.send(x)
+    count = -1
+    while count != len(pngs):
+        count = len(pngs)
+        time.sleep(1)
+    dec.stop()
+    if len(pngs) != len(feed):
+        print(f"Warning: {len(feed)} access units decoded to {len(pngs)} frames, so frame ages may be wrong")
+    indices = {}
+    for (index, crc) in enumerate(pngs):
+        indices.setdefault(crc, []).append(index)
+    return indices
+
+def _injected(box, png):
+    """When the newest access unit that decodes to this PNG was fed in, before the PNG was produced."""
+    crc = zlib.crc32(png)
+    produced = box.frame_times.get(crc)
+    if produced is None:
+        return None
+    latest = None
+    for index in box.frame_indices.get(crc, ()):
+        times = box.injected[index]
+        i = bisect.bisect_right(times, produced)
+        if i and (latest is None or times[i - 1] > latest):
+            latest = times[i - 1]
+    return latest
+
+def _snapshot_client(box, args, results, running):
+    count = 0
+    while running.is_set():
+        try:
+            conn = http.client.HTTPConnection("localhost", args.port, timeout=10)
+            conn.request("GET", f"/snapshot?{count}")
+            png = conn.getresponse().read()
+            conn.close()
+        except (OSError, http.client.HTTPException):
+            results.error()
+            continue
+        count += 1
+        injected = _injected(box, png) if png else None
+        if injected is not None:
+            results.add("frame_age", time.monotonic() - injected)
+
+def _stream_client(box, args, results, running):
+    try:
+        conn = http.client.HTTPConnection("localhost", args.port, timeout=10)
+        conn.request("GET", "/stream")
+        response = conn.getresponse()
+    except (OSError, http.client.HTTPException):
+        results.error()
+        return
+    received = 0
+    index = 0
+    while running.is_set():
+        chunk = response.read1(65536)
+        if not chunk:
+            results.error()
+            break
+        received += len(chunk)
+        now = time.monotonic()
+        # Every access unit now completely received was sent at a known time
+        while index < len(box.sent_times) and box.sent_times[index][0] <= received:
+            results.add("frame_age", now - box.sent_times[index][1])
+            index += 1
+    conn.close()
+
+def _touch_client(box, args, results, running):
+    actions = ["down"] + ["move"] * 8 + ["up"]
+    start = time.monotonic()
+    i = 0
+    while running.is_set():
+        body = simplejson.dumps({"type": actions[i % len(actions)], "x": i % 800, "y": i % 600})
+        sent = time.monotonic()
+        try:
+            conn = http.client.HTTPConnection("localhost", args.port, timeout=10)
+            conn.request("POST", "/touch", body)
+            ok = simplejson.loads(conn.getresponse().read()).get("ok")
+            conn.close()
+        except (OSError, http.client.HTTPException, ValueError):
+            ok = False
+        if ok:
+            results.add("touch", time.monotonic() - sent)
+        else:
+            results.error()
+        i += 1
+        delay = start + i / args.touch_rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def _synthetic_feed(args):
+    return subprocess.run(["ffmpeg", "-f", "lavfi", "-i", f"testsrc=size={args.size}:rate={args.fps}", "-t", "10", "-c:v", "libx264", "-tune", "zerolatency", "-f", "h264", "-"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+def _percentiles(values):
+    if len(values) < 2:
+        return {}
+    cuts = statistics.quantiles(values, n=100)
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+def _slo(text):
+    (name, limit) = text.split("=")
+    (metric, percentile) = name.rsplit("_", 1)
+    if metric not in ("frame", "touch") or percentile not in ("p50", "p95", "p99"):
+        raise argparse.ArgumentTypeError(f"unknown SLO {name}")
+    return (metric, percentile, float(limit))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--file", help="raw h264 (Annex B) file to replay (default: generate a test pattern with ffmpeg)")
+    parser.add_argument("--size", default="800x600", help="test pattern size")
+    parser.add_argument("--fps", type=float, default=30, help="VideoData messages per second")
+    parser.add_argument("--clients", type=int, default=4, help="simulated browsers")
+    parser.add_argument("--mode", choices=("snapshot", "stream"), default="snapshot", help="how the browsers get video")
+    parser.add_argument("--touchers", type=int, default=1, help="simulated touch sources")
+    parser.add_argument("--touch-rate", type=float, default=30, help="touch events per second per source")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to measure for")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds to run before measuring")
+    parser.add_argument("--port", type=int, default=9100, help="web server port")
+    parser.add_argument("--decoder", help="h264 decoder backend")
+    parser.add_argument("--slo", type=_slo, action="append", default=[], help="fail if exceeded, e.g. frame_p95=0.5 or touch_p99=0.05 (seconds)")
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            data = f.read()
+    else:
+        data = _synthetic_feed(args)
+    feed = h264.access_units(data)
+    frame_indices = _frame_indices(feed, args.decoder) if args.mode == "snapshot" else {}
+    box = _LoadBox(feed, frame_indices, args.fps, args.mode == "stream", decoder_backend=args.decoder, port=args.port)
+    threading.Thread(target=box.run, daemon=True).start()
+    while not box.started:
+        time.sleep(0.1)
+
+    results = _Results()
+    running = threading.Event()
+    running.set()
+    client = _snapshot_client if args.mode == "snapshot" else _stream_client
+    threads = [threading.Thread(target=client, args=(box, args, results, running), daemon=True) for _ in range(args.clients)]
+    threads += [threading.Thread(target=_touch_client, args=(box, args, results, running), daemon=True) for _ in range(args.touchers)]
+    for x in threads:
+        x.start()
+    time.sleep(args.warmup)
+    with results.lock:
+        results.frame_age.clear()
+        results.touch.clear()
+        results.errors = 0
+    time.sleep(args.duration)
+    running.clear()
+    with results.lock:
+        measured = {"frame": _percentiles(results.frame_age), "touch": _percentiles(results.touch)}
+        counts = {"frame": len(results.frame_age), "touch": len(results.touch)}
+        errors = results.errors
+    box.connection.stop()
+    box.decoder.stop()
+
+    print(f"{args.clients} {args.mode} clients, {args.touchers * args.touch_rate:g} touches/s, {args.duration:g}s, {errors} errors")
+    for metric in ("frame", "touch"):
+        values = " ".join(f"{k}={v * 1000:.1f}ms" for k, v in measured[metric].items())
+        print(f"{metric}: {counts[metric]} samples {values}")
+    failed = False
+    for (metric, percentile, limit) in args.slo:
+        value = measured[metric].get(percentile)
+        if value is None or value > limit:
+            failed = True
+            print(f"FAIL: {metric}_{percentile} {'no data' if value is None else f'{value * 1000:.1f}ms'} > {limit * 1000:g}ms")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
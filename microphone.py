@@ -0,0 +1,191 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Microphone uplink: buffers browser audio against network jitter, resamples it to the format the dongle asked for
+    and sends it upstream in batched AudioData messages."""
+
+import threading, time, statistics
+from collections import deque
+import numpy as np
+import protocol
+import profiler
+
+class _Resampler:
+    """Streaming low-pass and linear interpolation, vectorised over each chunk."""
+    taps = 31
+
+    def __init__(self, rate_in, rate_out, channels):
+        self.step = rate_in / rate_out
+        self.channels = channels
+        # Windowed-sinc low-pass at 90% of the lower Nyquist frequency, so downsampling doesn't alias
+        cutoff = 0.45 * min(rate_in, rate_out) / rate_in
+        n = np.arange(self.taps) - (self.taps - 1) / 2
+        self._filter = (2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(self.taps)).astype(np.float32)
+        self._filter /= self._filter.sum()
+        self._history = np.zeros(self.taps - 1, np.float32)
+        self._last = np.zeros(1, np.float32)
+        self._pos = 1.0 # position of the next output sample, in input samples after self._last
+
+    def process(self, samples):
+        x = np.concatenate((self._history, samples.astype(np.float32)))
+        self._history = x[len(x) - (self.taps - 1):]
+        x = np.concatenate((self._last, np.convolve(x, self._filter, mode='valid')))
+        end = len(x) - 1
+        count = int((end - self._pos) // self.step) + 1 if self._pos <= end else 0
+        positions = self._pos + self.step * np.arange(count)
+        out = np.interp(positions, np.arange(len(x)), x)
+        self._pos += self.step * count - end
+        self._last = x[-1:]
+        out = np.clip(np.rint(out), -32768, 32767).astype('<i2')
+        return np.repeat(out, self.channels) if self.channels > 1 else out
+
+class Uplink:
+    batch = 0.04 # seconds of audio per AudioData message, to keep the USB message rate down
+    min_delay = 0.02 # jitter buffer bounds (seconds)
+    max_delay = 0.1
+    budget = 0.15 # mouth-to-USB latency budget for a voice call (ITU-T G.114), beyond which old audio is dropped
+
+    class _Thread(threading.Thread):
+        def __init__(self, owner):
+            super().__init__(daemon=True)
+            self.owner = owner
+            profiler.register(self, "microphone")
+
+        def run(self):
+            while True:
+                self.owner._send_batch()
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._format = None
+        self._chunks = deque() # [arrival time, delay before arrival, samples]
+        self._reset()
+        self.latency = deque(maxlen=1000) # mouth-to-USB latencies since start(), in seconds
+        self.underruns = 0
+        self.dropped = 0
+        self.thread = self._Thread(self)
+        self.thread.start()
+
+    @property
+    def active(self):
+        return self._format is not None
+
+    def start(self, decodeType, audioType):
+        """Begin sending, in the format the dongle specified for decodeType."""
+        (rate, channels, bits) = protocol.AudioData._format_for_decodetype(decodeType)
+        if bits != 16:
+            raise ValueError(f"Unsupported microphone format {decodeType}")
+        with self._lock:
+            self._format = (decodeType, audioType, rate, channels)
+            self._resampler = None
+            self._reset()
+            self.latency.clear()
+            self.underruns = 0
+            self.dropped = 0
+            self._lock.notify()
+
+    def stop(self):
+        with self._lock:
+            self._format = None
+            self._reset()
+            self._lock.notify()
+
+    def summary(self):
+        """Latency statistics since start(), or None if nothing was sent."""
+        latency = list(self.latency)
+        if len(latency) < 2:
+            return None
+        cuts = statistics.quantiles(latency, n=20)
+        over = sum(1 for x in latency if x > self.budget)
+        return f"{len(latency)} batches, latency p50 {cuts[9] * 1000:.0f}ms p95 {cuts[18] * 1000:.0f}ms ({over} over the {self.budget * 1000:.0f}ms budget), {self.underruns} underruns, {self.dropped} samples dropped"
+
+    def _reset(self):
+        self._chunks.clear()
+        self._buffered = 0
+        self._jitter = 0
+        self._last_arrival = None
+        self._primed = False
+        self._next = 0
+
+    def on_input(self, rate, delay, samples):
+        """Add signed 16-bit mono samples at `rate` Hz, captured `delay` seconds before they were sent."""
+        arrival = time.monotonic()
+        with self._lock:
+            if self._format is None:
+                return
+            (decodeType, audioType, out_rate, channels) = self._format
+            # RFC 3550 style interarrival jitter estimate
+            duration = len(samples) / 2 / rate
+            if self._last_arrival is not None:
+                (last, last_duration) = self._last_arrival
+                self._jitter += (abs(arrival - last - last_duration) - self._jitter) / 16
+            self._last_arrival = (arrival, duration)
+            if self._resampler is None or self._resampler.step != rate / out_rate:
+                self._resampler = _Resampler(rate, out_rate, channels)
+            out = self._resampler.process(np.frombuffer(samples, '<i2'))
+            if len(out):
+                self._chunks.append([arrival, delay, out])
+                self._buffered += len(out)
+                self._lock.notify()
+
+    @property
+    def target(self):
+        """Current jitter buffer depth, in seconds."""
+        return min(max(4 * self._jitter, self.min_delay), self.max_delay)
+
+    def _take(self, count):
+        parts = []
+        first = self._chunks[0]
+        while count and self._chunks:
+            chunk = self._chunks[0]
+            part = chunk[2][:count]
+            chunk[2] = chunk[2][count:]
+            if not len(chunk[2]):
+                self._chunks.popleft()
+            parts.append(part)
+            count -= len(part)
+        data = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        self._buffered -= len(data)
+        return (first, data)
+
+    def _send_batch(self):
+        # Send in real time, one batch per batch period
+        delay = self._next - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        with self._lock:
+            while self._format is None:
+                self._lock.wait()
+            current = self._format
+            (decodeType, audioType, rate, channels) = current
+            size = int(rate * self.batch) * channels
+            # Wait for the buffer to fill to its target depth (again, after an underrun)
+            while self._buffered < (size + (0 if self._primed else self.target * rate * channels)):
+                if self._primed:
+                    self._primed = False
+                    self.underruns += 1
+                self._lock.wait()
+                if self._format is not current:
+                    return # stopped, or restarted in another format
+            if not self._primed:
+                self._primed = True
+                self._next = time.monotonic()
+            self._next += self.batch
+            # Stay within the latency budget by dropping the oldest audio
+            excess = self._buffered - int((self.target + self.batch) * rate) * channels
+            if excess >= channels and time.monotonic() - self._chunks[0][0] + self._chunks[0][1] > self.budget:
+                excess -= excess % channels
+                self._take(excess)
+                self.dropped += excess
+            ((arrival, delay, _), data) = self._take(size)
+        msg = protocol.AudioData()
+        msg.decodeType = decodeType
+        msg.audioType = audioType
+        msg.data = data.tobytes()
+        self.send_message(msg)
+        self.latency.append(time.monotonic() - arrival + delay)
+
+    def send_message(self, message):
+        """Callback to send an AudioData message to the dongle [called from a worker thread]."""
+        pass
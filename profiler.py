@@ -0,0 +1,106 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Per-thread CPU accounting and a sampling profiler, for finding what's busy in a running process."""
+
+import os, sys, threading, time, weakref
+from collections import Counter
+
+_registered = weakref.WeakSet()
+
+def register(thread, name):
+    """Name a thread so it can be told apart in CPU usage and profiles; returns the thread."""
+    thread.name = name
+    _registered.add(thread)
+    return thread
+
+def thread_time(ident):
+    """CPU seconds used so far by the thread with the given ident, or None where unsupported."""
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+class CPUMonitor:
+    """Samples each thread's CPU time every `interval` seconds, to report what each used over the last interval."""
+    interval = 5
+
+    class _Thread(threading.Thread):
+        def __init__(self, owner):
+            super().__init__(daemon=True)
+            self.owner = owner
+            register(self, "cpu-monitor")
+
+        def run(self):
+            while True:
+                self.owner._sample()
+                time.sleep(self.owner.interval)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = None
+        self._usage = []
+        self.thread = self._Thread(self)
+        self.thread.start()
+
+    def _sample(self):
+        now = time.monotonic()
+        process = time.process_time()
+        times = {x.ident: (x, thread_time(x.ident)) for x in threading.enumerate() if x.ident is not None}
+        usage = []
+        if self._last is not None:
+            (then, last_process, last_times) = self._last
+            elapsed = now - then
+            for (ident, (thread, cpu)) in times.items():
+                before = last_times.get(ident, (None, None))[1]
+                usage.append({
+                    "name": thread.name,
+                    "registered": thread in _registered,
+                    "cpu": None if cpu is None else round(cpu, 3),
+                    "percent": None if cpu is None or before is None else round(100 * (cpu - before) / elapsed, 1),
+                })
+            usage.sort(key=lambda x: x["percent"] or 0, reverse=True)
+            usage.insert(0, {"name": "process", "registered": True, "cpu": round(process, 3), "percent": round(100 * (process - last_process) / elapsed, 1)})
+        with self._lock:
+            self._last = (now, process, times)
+            self._usage = usage
+
+    def usage(self):
+        """Per-thread CPU seconds, and percent of one core over the last interval, busiest first."""
+        with self._lock:
+            return list(self._usage)
+
+_profiling = threading.Lock()
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def profile(seconds, interval=0.01, idle=False):
+    """Sample every thread's stack each `interval` for `seconds`, returning collapsed stacks ("thread;outer;...;inner
+        count" lines, as read by flamegraph.pl or speedscope). Unless `idle`, only threads that used CPU since the
+        previous sample are counted."""
+    stacks = Counter()
+    me = threading.get_ident()
+    last = {}
+    with _profiling: # one at a time, so concurrent requests can't multiply the overhead
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            names = {x.ident: x.name for x in threading.enumerate()}
+            for (ident, frame) in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if not idle:
+                    cpu = thread_time(ident)
+                    if cpu is not None:
+                        (before, last[ident]) = (last.get(ident), cpu)
+                        if before is None or cpu == before:
+                            continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(";", ":"))
+                stacks[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for (stack, count) in stacks.most_common())
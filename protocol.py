@@ -1,4 +1,3 @@
-
 # "Autobox" dongle driver for HTML 'streaming'
 # Created by Colin Munro, December 2019
 # See README.md for more information
@@ -7,6 +6,7 @@
 
 import struct
 from enum import IntEnum
+from operator import attrgetter
 
 def _setenum(enum, val):
     try:
@@ -14,11 +14,294 @@ def _setenum(enum, val):
     except ValueError:
         return val
 
+# Message bodies are described declaratively with the classes below; each Schema compiles runs of
+# fixed-size fields into a single struct.Struct once, at class definition time.
+
+class Field:
+    """A fixed-size value, packed with a struct format code."""
+    plain = True # packed as is, without encode()
+
+    def __init__(self, name, code, enum=None):
+        self.name = name
+        self.code = code
+        self.enum = enum
+
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value if self.enum is None else _setenum(self.enum, value)
+
+class Text(Field):
+    """A fixed-size, NUL padded ASCII string."""
+    plain = False
+
+    def __init__(self, name, size):
+        super().__init__(name, f"{size}s")
+
+    def encode(self, value):
+        return value.encode('ascii')
+
+    def decode(self, value):
+        return value.decode('ascii').rstrip('\x00')
+
+class Bool(Field):
+    """A flag, sent as a 32-bit 0 or 1."""
+    plain = False
+
+    def __init__(self, name):
+        super().__init__(name, "L")
+
+    def encode(self, value):
+        return 1 if value else 0
+
+    def decode(self, value):
+        return bool(value)
+
+class _Group:
+    """Consecutive Fields, sharing one precompiled struct."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.names = [x.name for x in fields]
+        self.struct = struct.Struct("<" + "".join(x.code for x in fields))
+        self.fixed = self.struct.size
+        self.packs_plain = all(x.plain for x in fields)
+        self.unpacks_plain = self.packs_plain and all(x.enum is None for x in fields)
+        get = attrgetter(*self.names)
+        self.values = get if len(fields) > 1 else lambda obj: (get(obj),)
+
+    def size(self, obj):
+        return self.fixed
+
+    def pack_into(self, obj, buffer, offset):
+        values = self.values(obj)
+        if not self.packs_plain:
+            values = [f.encode(v) for f, v in zip(self.fields, values)]
+        self.struct.pack_into(buffer, offset, *values)
+        return offset + self.fixed
+
+    def unpack_from(self, obj, buffer, offset, end):
+        if offset + self.fixed > end:
+            raise struct.error(f"need {self.fixed} bytes, have {end - offset}")
+        values = self.struct.unpack_from(buffer, offset)
+        if self.unpacks_plain:
+            obj.__dict__.update(zip(self.names, values))
+        else:
+            for f, v in zip(self.fields, values):
+                setattr(obj, f.name, f.decode(v))
+        return offset + self.fixed
+
+class Prefixed:
+    """Variable length data preceded by its 32-bit length; text is sent NUL terminated."""
+    _length = struct.Struct("<L")
+    fixed = None
+
+    def __init__(self, name, text=False):
+        self.name = name
+        self.names = [name]
+        self.text = text
+
+    def _encode(self, obj):
+        value = getattr(obj, self.name)
+        return (value + '\0').encode('ascii') if self.text else value
+
+    def size(self, obj):
+        return self._length.size + len(self._encode(obj))
+
+    def pack_into(self, obj, buffer, offset):
+        value = self._encode(obj)
+        self._length.pack_into(buffer, offset, len(value))
+        offset += self._length.size
+        buffer[offset:offset + len(value)] = value
+        return offset + len(value)
+
+    def unpack_from(self, obj, buffer, offset, end):
+        if offset + self._length.size > end:
+            raise struct.error("missing length")
+        (length,) = self._length.unpack_from(buffer, offset)
+        offset += self._length.size
+        if offset + length > end:
+            raise struct.error(f"need {length} bytes, have {end - offset}")
+        value = bytes(buffer[offset:offset + length])
+        setattr(obj, self.name, value.decode('ascii').rstrip('\x00') if self.text else value)
+        return offset + length
+
+class Rest:
+    """Everything remaining in the message."""
+    fixed = None
+
+    def __init__(self, name, text=False):
+        self.name = name
+        self.names = [name]
+        self.text = text
+
+    def size(self, obj):
+        return len(getattr(obj, self.name))
+
+    def pack_into(self, obj, buffer, offset):
+        value = getattr(obj, self.name)
+        buffer[offset:offset + len(value)] = value
+        return offset + len(value)
+
+    def unpack_from(self, obj, buffer, offset, end):
+        # The one copy: the payload must not alias a buffer that may be reused
+        value = bytes(buffer[offset:end])
+        setattr(obj, self.name, value.decode('ascii').rstrip('\x00') if self.text else value)
+        return end
+
+class Array:
+    """Fixed-size records (described by their own Schema) filling the rest of the message."""
+    fixed = None
+
+    def __init__(self, name, schema, factory):
+        if schema.fixed is None:
+            raise ValueError("Array records must be of fixed size")
+        self.name = name
+        self.names = [name]
+        self.schema = schema
+        self.factory = factory
+
+    def size(self, obj):
+        return self.schema.fixed * len(getattr(obj, self.name))
+
+    def pack_into(self, obj, buffer, offset):
+        for x in getattr(obj, self.name):
+            offset = self.schema.pack_into(x, buffer, offset)
+        return offset
+
+    def unpack_from(self, obj, buffer, offset, end):
+        (count, extra) = divmod(end - offset, self.schema.fixed)
+        if extra:
+            raise struct.error("partial record")
+        items = []
+        for _ in range(count):
+            x = self.factory()
+            offset = self.schema.unpack_from(x, buffer, offset, offset + self.schema.fixed)
+            items.append(x)
+        setattr(obj, self.name, items)
+        return offset
+
+class Optional:
+    """Trailing fields that are only present when `flag` is set (and, when reading, when there is data left)."""
+    fixed = None
+
+    def __init__(self, flag, *fields):
+        self.flag = flag
+        self.group = _Group(fields)
+        self.names = [flag] + self.group.names
+
+    def size(self, obj):
+        return self.group.fixed if getattr(obj, self.flag) else 0
+
+    def pack_into(self, obj, buffer, offset):
+        if getattr(obj, self.flag):
+            offset = self.group.pack_into(obj, buffer, offset)
+        return offset
+
+    def unpack_from(self, obj, buffer, offset, end):
+        present = offset != end
+        setattr(obj, self.flag, present)
+        return self.group.unpack_from(obj, buffer, offset, end) if present else offset
+
+class Switch:
+    """One of several tails: reading picks by remaining length, writing picks the first whose value is not None."""
+    fixed = None
+
+    def __init__(self, *options):
+        self.options = [_Group([x]) if isinstance(x, Field) else x for x in options]
+        self.names = [name for x in self.options for name in x.names]
+
+    def _choose(self, obj):
+        for x in self.options:
+            if getattr(obj, x.names[0]) is not None:
+                return x
+        raise ValueError("No value to send")
+
+    def size(self, obj):
+        return self._choose(obj).size(obj)
+
+    def pack_into(self, obj, buffer, offset):
+        return self._choose(obj).pack_into(obj, buffer, offset)
+
+    def unpack_from(self, obj, buffer, offset, end):
+        remaining = end - offset
+        option = next((x for x in self.options if x.fixed == remaining), None)
+        if option is None:
+            option = next((x for x in self.options if x.fixed is None), None)
+        if option is None:
+            raise struct.error(f"no option for {remaining} bytes")
+        for name in self.names:
+            setattr(obj, name, None)
+        return option.unpack_from(obj, buffer, offset, end)
+
+class Schema:
+    """A compiled message body layout, readable from and writable to any buffer without intermediate copies."""
+
+    def __init__(self, *items):
+        self.segments = []
+        fields = []
+        for x in items + (None,):
+            if isinstance(x, Field):
+                fields.append(x)
+                continue
+            if fields:
+                self.segments.append(_Group(fields))
+                fields = []
+            if x is not None:
+                self.segments.append(x)
+        sizes = [x.fixed for x in self.segments]
+        self.fixed = None if None in sizes else sum(sizes)
+        # A body that is just one run of plain fields can be packed with a single struct call
+        self.flat = None
+        if not self.segments:
+            self.flat = (struct.Struct("<"), lambda obj: ())
+        elif len(self.segments) == 1 and isinstance(self.segments[0], _Group) and self.segments[0].packs_plain:
+            self.flat = (self.segments[0].struct, self.segments[0].values)
+
+    def size(self, obj):
+        if self.fixed is not None:
+            return self.fixed
+        return sum(x.size(obj) for x in self.segments)
+
+    def pack_into(self, obj, buffer, offset=0):
+        """Write obj's fields into buffer at offset, returning the offset after them."""
+        for x in self.segments:
+            offset = x.pack_into(obj, buffer, offset)
+        return offset
+
+    def unpack_from(self, obj, buffer, offset=0, end=None):
+        """Set obj's fields from buffer[offset:end], which must be consumed exactly."""
+        if end is None:
+            end = len(buffer)
+        for x in self.segments:
+            offset = x.unpack_from(obj, buffer, offset, end)
+        if offset != end:
+            raise struct.error(f"{end - offset} unexpected trailing bytes")
+        return offset
+
+    def pack(self, obj):
+        buffer = bytearray(self.size(obj))
+        self.pack_into(obj, buffer)
+        return bytes(buffer)
+
 class Message:
     """Base dongle message, indicating message size and type."""
     magic = 0x55aa55aa
     headersize = 4 * 4
-    
+    schema = None # body layout; messages without one carry their body as raw bytes
+    _header = struct.Struct("<LLLL")
+    _packer = None # header and body in one struct, where the schema has a flat body
+    _types = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.schema is not None and cls.schema.flat is not None:
+            (body, values) = cls.schema.flat
+            cls._packer = struct.Struct(cls._header.format + body.format[1:])
+            cls._header_values = (cls.magic, cls.schema.fixed, cls.msgtype, (cls.msgtype ^ -1) & 0xffffffff)
+            cls._flat_values = staticmethod(values)
+
     @classmethod
     def _allmessages(cls):
         """Get a dictionary mapping message types to messages."""
@@ -28,136 +311,198 @@ class Message:
                 msgs[x.msgtype] = x
             msgs.update(x._allmessages())
         return msgs
-    
+
     def upgrade(self, bodydata):
         """Convert a message containing only its header to the concrete message type (if known)."""
+        if Message._types is None:
+            Message._types = Message._allmessages()
         try:
-            upd=self._allmessages()[self.type]()
+            upd=Message._types[self.type]()
             upd._setdata(bodydata)
             upd._check_type()
         except KeyError:
             upd=Unknown(self.type)
             upd._setdata(bodydata)
-        except struct.error:
+        except (struct.error, ValueError):
             upd=Unknown(self.type)
-            upd._setdata(bodydata)    
+            upd._setdata(bodydata)
         return upd
-    
+
     def __init__(self, type=-1):
         if type == -1 and hasattr(self, "msgtype"):
             self.type = self.msgtype
         else:
             self.type = type
-    
-    def serialise(self):
-        data = self._data()
-        return struct.pack("<LLLL", self.magic, len(data), self.type, (self.type ^ -1) & 0xffffffff) + data
-    
-    def deserialise(self, data):
-        (magic, datalen, self.type, typecheck) = struct.unpack("<LLLL", data[:16])
-        if typecheck != (self.type ^ -1) & 0xffffffff:
+
+    @classmethod
+    def unpack_header(cls, buffer, offset=0):
+        """Read and check a message header, returning (type, body length)."""
+        (magic, datalen, type, typecheck) = cls._header.unpack_from(buffer, offset)
+        if typecheck != (type ^ -1) & 0xffffffff:
             raise ValueError("Message failed check")
-        if magic != self.magic:
+        if magic != cls.magic:
             raise ValueError("Magic number incorrect")
+        return (type, datalen)
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Decode a complete message (header and body) from buffer, returning the concrete message type."""
+        (type, datalen) = cls.unpack_header(buffer, offset)
+        offset += cls.headersize
+        if offset + datalen > len(buffer):
+            raise ValueError("Message truncated")
+        return Message(type).upgrade(memoryview(buffer)[offset:offset + datalen])
+
+    def size(self):
+        """Serialised size, including the header."""
+        if self.schema is None:
+            return self.headersize + len(self._data())
+        return self.headersize + self.schema.size(self)
+
+    def pack_into(self, buffer, offset=0):
+        """Write the serialised message into buffer at offset, returning the offset after it."""
+        if self._packer is not None:
+            self._packer.pack_into(buffer, offset, *self._header_values, *self._flat_values(self))
+            return offset + self._packer.size
+        if self.schema is None:
+            data = self._data()
+            datalen = len(data)
+        else:
+            datalen = self.schema.size(self)
+        self._header.pack_into(buffer, offset, self.magic, datalen, self.type, (self.type ^ -1) & 0xffffffff)
+        offset += self.headersize
+        if self.schema is None:
+            buffer[offset:offset + datalen] = data
+            return offset + datalen
+        return self.schema.pack_into(self, buffer, offset)
+
+    def serialise(self):
+        if self._packer is not None:
+            return self._packer.pack(*self._header_values, *self._flat_values(self))
+        data = bytearray(self.size())
+        self.pack_into(data)
+        return bytes(data)
+
+    def deserialise(self, data):
+        (self.type, datalen) = self.unpack_header(data)
         rest = data[16:]
         if len(rest) == datalen:
             self._setdata(rest[:datalen])
         else:
             self._setdata(b'\0' * datalen)
         self._check_type()
-        
+
     def _check_type(self):
         if hasattr(self, "msgtype"):
             if self.type != self.msgtype:
                 raise ValueError("Type mis-restored")
 
     def _data(self):
-        return self._default_data
-    
+        if self.schema is None:
+            return self._default_data
+        return self.schema.pack(self)
+
     def _setdata(self, data):
-        self._default_data = data
+        if self.schema is None:
+            self._default_data = bytes(data)
+        else:
+            self.schema.unpack_from(self, data)
 
 class Unknown(Message):
     pass
 
+class Parser:
+    """Splits a stream of bytes from the dongle into messages, however it was divided into transfers."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.discarded = 0
+
+    def feed(self, data):
+        """Add received data, returning the list of messages it completed."""
+        self._buffer += data
+        messages = []
+        offset = 0
+        with memoryview(self._buffer) as view:
+            while len(view) - offset >= Message.headersize:
+                try:
+                    (type, datalen) = Message.unpack_header(view, offset)
+                except ValueError:
+                    # Lost sync: skip to the next thing that looks like a header
+                    found = self._buffer.find(struct.pack("<L", Message.magic), offset + 1)
+                    skip = (found if found != -1 else len(view) - 3) - offset
+                    self.discarded += skip
+                    offset += skip
+                    continue
+                end = offset + Message.headersize + datalen
+                if end > len(view):
+                    break
+                messages.append(Message(type).upgrade(view[offset + Message.headersize:end]))
+                offset = end
+        del self._buffer[:offset]
+        return messages
+
 class SendFile(Message):
     msgtype = 153
-    
+    schema = Schema(Prefixed("filename", text=True), Prefixed("content"))
+
     def __init__(self, filename = "", content = b""):
         super().__init__(self.msgtype)
         self.filename = filename
         self.content = content
-    
-    def _data(self):
-        actualfilename = (self.filename + '\0').encode('ascii')
-        return struct.pack("<L", len(actualfilename)) + actualfilename + struct.pack("<L", len(self.content)) + self.content
-    
-    def _setdata(self, data):
-        (length,) = struct.unpack("<L", data[:4])
-        self.filename = data[4:][:length - 1].decode('ascii')
-        second = data[4 + length:]
-        (length,) = struct.unpack("<L", second[:4])
-        self.content = second[4:][:length]
 
 class Open(Message):
     msgtype = 1
-    
-    def __init__(self):
+    schema = Schema(
+        Field("width", "L"),
+        Field("height", "L"),
+        Field("videoFrameRate", "L"),
+        Field("format", "L"),
+        Field("packetMax", "L"),
+        Field("iBoxVersion", "L"),
+        Field("phoneWorkMode", "L"),
+    )
+
+    def __init__(self, width = 800, height = 600, fps = 60):
         super().__init__(self.msgtype)
         # Some default values to use
-        self.width = 800
-        self.height = 600
-        self.videoFrameRate = 60
+        self.width = width
+        self.height = height
+        self.videoFrameRate = fps
         self.format = 5
         self.packetMax = 49152
         self.iBoxVersion = 2
         self.phoneWorkMode = 2
-    
-    def _data(self):
-        return struct.pack("<LLLLLLL", self.width, self.height, self.videoFrameRate, self.format, self.packetMax, self.iBoxVersion, self.phoneWorkMode)
-    
-    def _setdata(self, data):
-        (self.width, self.height, self.videoFrameRate, self.format, self.packetMax, self.iBoxVersion, self.phoneWorkMode) = struct.unpack("<LLLLLLL", data)
 
 class Heartbeat(Message):
     msgtype = 170
     lifecycle = 2 # seconds
-    
+    schema = Schema()
+
     def __init__(self):
         super().__init__(self.msgtype)
-    
-    def _data(self):
-        return b""
-    
-    def _setdata(self, data):
-        if len(data):
-            raise ValueError("Heartbeat message should not contain data")
 
 class ManufacturerInfo(Message):
     msgtype = 20
-    
-    def __init__(self, a = -1, b = -1):
+    schema = Schema(Field("a", "L"), Field("b", "L"))
+
+    def __init__(self, a = 0, b = 0):
         super().__init__(self.msgtype)
         self.a = a
         self.b = b
-    
-    def _data(self):
-        return struct.pack("<LL", self.a, self.b)
-    
-    def _setdata(self,data):
-        (self.a, self.b) = struct.unpack("<LL", data)
 
 class CarPlay(Message):
     msgtype = 8
-    
+
     class Value(IntEnum):
         Invalid = 0
         BtnSiri = 5
         CarMicrophone = 7
+        RequestKeyFrame = 12
         BtnLeft = 100
         BtnRight = 101
         BtnSelectDown = 104
-        BtnSelectUp = 105 
+        BtnSelectUp = 105
         BtnBack = 106
         BtnDown = 114
         BtnHome = 200
@@ -167,101 +512,74 @@ class CarPlay(Message):
         BtnPrevTrack = 205
         SupportWifi = 1000
         SupportWifiNeedKo = 1012
-    
+
+    schema = Schema(Field("value", "L", enum=Value))
+
     def __init__(self, v = 0):
         super().__init__(self.msgtype)
         self.value = _setenum(self.Value, v)
 
-    def _data(self):
-        return struct.pack("<L", self.value)
-    
-    def _setdata(self, data):
-        (v,) = struct.unpack("<L", data)
-        self.value = _setenum(self.Value, v)
-
 class SoftwareVersion(Message):
     msgtype = 204
-    
+    schema = Schema(Text("version", 32))
+
     def __init__(self, swv = ""):
         super().__init__(self.msgtype)
         self.version = swv
-    
-    def _data(self):
-        s = self.version.encode('ascii')
-        return s + b'\0' * (32 - len(s))
-    
-    def _setdata(self, data):
-        self.version = bytearray(data).decode('ascii').rstrip('\x00')
 
 class BluetoothAddress(Message):
     msgtype = 10
-    
+    schema = Schema(Text("address", 17))
+
     def __init__(self):
         super().__init__(self.msgtype)
         self.address = "1f:ea:27:37:d6:51" # randomly generated, just for testing
-    
-    def _data(self):
-        return self.address.encode('ascii')
-    
-    def _setdata(self, data):
-        self.address = bytearray(data).decode('ascii')
-        if len(self.address) != 17:
-            raise "wrong length data"
 
 class BluetoothPIN(Message):
     msgtype = 12
-    
+    schema = Schema(Text("pin", 4))
+
     def __init__(self):
         super().__init__(self.msgtype)
         self.pin = "1234"
-    
-    def _data(self):
-        return self.pin.encode('ascii')
-    
-    def _setdata(self, data):
-        self.pin = bytearray(data).decode('ascii')
-        if len(self.pin) != 4:
-            raise ValueError("Wrong length data")
 
 class Plugged(Message):
     msgtype = 2
-    
+    schema = Schema(Field("phone_type", "L"), Optional("wifistyle", Bool("wifi")))
+
     def __init__(self, wifistyle = False):
         super().__init__(self.msgtype)
         self.wifistyle = wifistyle
         self.phone_type = 0
         self.wifi = False
-    
-    def _data(self):
-        if self.wifistyle:
-            return struct.pack("<LL", self.phone_type, 1 if self.wifi else 0)
-        else:
-            return struct.pack("<L", self.phone_type)
-
-    def _setdata(self, data):
-        self.wifistyle = len(data) == 8
-        if self.wifistyle:
-            (self.phone_type, self.wifi) = struct.unpack("<LL", data)
-        else:
-            (self.phone_type,) = struct.unpack("<L", data)
 
 class Unplugged(Message):
     msgtype = 4
+    schema = Schema()
 
 class VideoData(Message):
     msgtype = 6
-    
+    schema = Schema(
+        Field("width", "L"),
+        Field("height", "L"),
+        Field("flags", "L"),
+        Field("unknown1", "L"),
+        Field("unknown2", "L"),
+        Rest("data"), # at least for format==5, this is h264
+    )
+
     def __init__(self):
         super().__init__(self.msgtype)
-    
-    def _setdata(self, data):
-        (self.width, self.height, self.flags, self.unknown1, self.unknown2) = struct.unpack("<LLLLL", data[:20])
-        # at least for format==5, self.data is h264
-        self.data = data[20:]
+        self.width = 0
+        self.height = 0
+        self.flags = 0
+        self.unknown1 = 0
+        self.unknown2 = 0
+        self.data = b''
 
 class AudioData(Message):
     msgtype = 7
-    
+
     class Command(IntEnum):
         AUDIO_OUTPUT_START = 1
         AUDIO_OUTPUT_STOP = 2
@@ -274,7 +592,16 @@ class AudioData(Message):
         AUDIO_SIRI_STOP = 9
         AUDIO_MEDIA_START = 0xA
         AUDIO_MEDIA_STOP = 0xB
-    
+
+    # Exactly one of command, volumeDuration or data is set; data is uncompressed, of the format
+    # specified by decodeType (ints appear to be signed)
+    schema = Schema(
+        Field("decodeType", "L"),
+        Field("volume", "f"),
+        Field("audioType", "L"),
+        Switch(Field("command", "B", enum=Command), Field("volumeDuration", "L"), Rest("data")),
+    )
+
     @staticmethod
     def _format_for_decodetype(x):
         one = (44100, 2, 16)
@@ -288,71 +615,63 @@ class AudioData(Message):
             7: (16000, 2, 16),
         }
         return options.get(x, (0, 0, 0))
-    
+
     def __init__(self):
         super().__init__(self.msgtype)
-    
-    def _setdata(self, data):
-        amount = len(data) - 12
-        (self.decodeType, self.volume, self.audioType) = struct.unpack("<LfL", data[:12])
-        if amount == 1:
-            self.command = _setenum(self.Command, data[12])
-        elif amount == 4:
-            self.volumeDuration = struct.unpack("<L", data[12:])
-        else:
-            # data is uncompressed, of the format specified in self.decodeType (ints appear to be signed)
-            self.data = data[12:]
+        self.decodeType = 0
+        self.volume = 0.0
+        self.audioType = 0
+        self.command = None
+        self.volumeDuration = None
+        self.data = None
 
-# X/Y are scaled from 0 to 10000 regardless of device resolution
+# X/Y are scaled from 0 to 10000 regardless of device resolution
 class Touch(Message):
     msgtype = 5
-    
+
     class Action(IntEnum):
         Down = 14
         Move = 15
         Up = 16
-    
+
+    schema = Schema(Field("action", "L", enum=Action), Field("x", "L"), Field("y", "L"), Field("flags", "L"))
+
     def __init__(self):
         super().__init__(self.msgtype)
         self.x = 0
         self.y = 0
         self.action = self.Action.Up
-    
-    def _data(self):
-        return struct.pack("<LLLL", self.action.value, self.x, self.y, 0)
-    
-    def _setdata(self, data):
-        (action, self.x, self.y, self.flags) = struct.unpack("<LLLL", data)
-        self.action = _setenum(self.Action, action)
+        self.flags = 0
 
 class MultiTouch(Message):
     msgtype = 23
-    
+
     class Touch:
         class Action(IntEnum):
             Down = 1
             Move = 2
             Up = 0
-        
+
+        schema = Schema(Field("x", "f"), Field("y", "f"), Field("action", "L", enum=Action), Field("id", "L"))
+
         def __init__(self):
             self.x = 0
             self.y = 0
             self.action = self.Action.Up
             self.id = 4
-        
+
         def serialise(self):
-            return struct.pack("<ffLL", self.x, self.y, self.action.value, self.id)
-    
+            return self.schema.pack(self)
+
+    schema = Schema(Array("touches", Touch.schema, Touch))
+
     def __init__(self):
         super().__init__(self.msgtype)
         self.touches = []
-    
-    def _data(self):
-        return b''.join([x.serialise() for x in self.touches])
 
 def _send_string(filename, s):
     if len(s) > 16:
-        raise "String too long"
+        raise ValueError("String too long")
     return SendFile(filename, s.encode('ascii'))
 
 def _send_int(filename, i):
@@ -375,8 +694,14 @@ opened_info = [
    _send_string("/etc/box_name", "Teslabox"),
 ]
 
-startup_info = [
-    _send_int("/tmp/screen_dpi", 160),
-] + _copy_assets(_assets) + [
-    Open(),
-]
+def __getattr__(name):
+    # The assets are only read when first used, so that the module can be imported without them (e.g. by tests)
+    if name == "startup_files":
+        # Everything to send at startup before Open, which carries the requested video geometry
+        value = [_send_int("/tmp/screen_dpi", 160)] + _copy_assets(_assets)
+    elif name == "startup_info":
+        value = __getattr__("startup_files") + [Open()]
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -6,35 +6,50 @@
 """Utility code to open a web server with 100 handler threads and respond to requests for static PNGs of the
     current frame, and send touches back. Includes the HTML to do so."""
 
-import threading, socket
+import threading, socket, struct, base64, hashlib, time
 from queue import Queue
 from functools import partial
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import urllib
 import simplejson
+import profiler
+
+_websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
 class Server:
+	viewer_timeout = 10 # seconds after its last snapshot request that a browser no longer counts as a viewer
+	max_profile = 60 # longest /profile run, in seconds
 
 	def __init__(self, port=9000, thread_pool=100):
+		self._viewers = {}
+		self.cpu = profiler.CPUMonitor()
 		self.streams = []
 		self.streamdata = []
+		self.streamlock = threading.Lock()
 		self.addr = ('', port)
 		self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		self.sock.bind(self.addr)
 		self.sock.listen(5)
-		[self._Thread(self) for i in range(thread_pool)]
+		[self._Thread(self, i) for i in range(thread_pool)]
+
+	def viewers(self):
+		"""Display sizes, in device pixels, of the browsers currently polling for snapshots."""
+		now = time.monotonic()
+		return [(width, height) for (width, height, seen) in list(self._viewers.values()) if now - seen < self.viewer_timeout]
 
 	def send_stream(self, data):
-		self.streamdata.append(data)
-		for x in self.streams:
-			x.stream.put(data)
+		with self.streamlock:
+			self.streamdata.append(data)
+			for x in self.streams:
+				x.stream.put(data)
 
 	class _Thread(threading.Thread):
-		def __init__(self, owner):
+		def __init__(self, owner, index):
 			super().__init__()
 			self.owner = owner
 			self.daemon = True
+			profiler.register(self, f"http-{index}")
 			self.start()
 		def run(self):
 			httpd = HTTPServer(self.owner.addr, partial(self.owner._Handler, self.owner), False)
@@ -60,18 +75,69 @@ img {
 position: absolute;
 top: 50%;
 left: 50%;
-width: 800px;
-height: 600px;
-margin-top: -400px;
-margin-left: -300px;
+transform: translate(-50%, -50%);
+}
+#mic {
+position: absolute;
+top: 8px;
+left: 8px;
 }
 </style>
 </head>
 <body onload="run()" style="margin: 0px; background: #000000;">
 <img id="display">
+<button id="mic" onclick="togglemic()">Mic</button>
 <script>
+var microphone = null;
+function togglemic() {
+	if (microphone !== null) {
+		microphone.close();
+		return;
+	}
+	navigator.mediaDevices.getUserMedia({audio: {echoCancellation: true, noiseSuppression: true, autoGainControl: true}})
+	.then((stream) => {
+		var context = new AudioContext({latencyHint: "interactive"});
+		var source = context.createMediaStreamSource(stream);
+		var processor = context.createScriptProcessor(1024, 1, 1);
+		var socket = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") + location.host + "/microphone");
+		socket.binaryType = "arraybuffer";
+		socket.onopen = function(){
+			socket.send(JSON.stringify({"rate": context.sampleRate}));
+			source.connect(processor);
+			processor.connect(context.destination);
+		};
+		processor.onaudioprocess = function(event){
+			// Rather drop audio than let latency build up behind a slow connection
+			if (socket.readyState != WebSocket.OPEN || socket.bufferedAmount > 8192)
+				return;
+			var input = event.inputBuffer.getChannelData(0);
+			var packet = new DataView(new ArrayBuffer(8 + input.length * 2));
+			packet.setFloat64(0, input.length / context.sampleRate + (context.baseLatency || 0), true);
+			for (var i = 0; i < input.length; i++)
+				packet.setInt16(8 + i * 2, Math.max(-32768, Math.min(32767, input[i] * 32768)), true);
+			socket.send(packet.buffer);
+		};
+		microphone = {close: function(){
+			microphone = null;
+			processor.disconnect();
+			source.disconnect();
+			socket.close();
+			stream.getTracks().forEach((track) => track.stop());
+			context.close();
+			document.getElementById("mic").textContent = "Mic";
+		}};
+		socket.onclose = function(){
+			if (microphone !== null)
+				microphone.close();
+		};
+		document.getElementById("mic").textContent = "Mic on";
+	});
+}
 function mouse(type, event) {
-	fetch("/touch", {method: 'POST', cache: 'no-cache', body: JSON.stringify({"type": type, "x": event.offsetX, "y": event.offsetY})})
+	// Send the position in frame pixels, however the image is scaled
+	var x = event.offsetX * image.naturalWidth / image.clientWidth;
+	var y = event.offsetY * image.naturalHeight / image.clientHeight;
+	fetch("/touch", {method: 'POST', cache: 'no-cache', body: JSON.stringify({"type": type, "x": x, "y": y})})
 	.then((response) => {
 		return response.json();
 	})
@@ -92,10 +158,19 @@ function loadimage(url, handle) {
 }
 var image = document.getElementById("display");
 var count = 0;
+function snapshoturl() {
+    // Tell the server how many pixels we can show, so it can ask the phone for no more than that
+    var scale = window.devicePixelRatio || 1;
+    return "/snapshot?n=" + count.toString() + "&w=" + Math.round(window.innerWidth * scale).toString() + "&h=" + Math.round(window.innerHeight * scale).toString();
+}
 function handle(img) {
-    if (img !== null)
+    if (img !== null) {
+        var scale = Math.min(window.innerWidth / img.naturalWidth, window.innerHeight / img.naturalHeight);
+        image.style.width = (img.naturalWidth * scale).toString() + "px";
+        image.style.height = (img.naturalHeight * scale).toString() + "px";
         image.src = img.src;
-    loadimage("/snapshot?" + count.toString(), handle);
+    }
+    loadimage(snapshoturl(), handle);
     count++;
 }
 function run() {
@@ -113,7 +188,7 @@ function run() {
 		mousedown = false;
 		mouse("up", event);
 	};
-    loadimage("/snapshot", handle);
+    loadimage(snapshoturl(), handle);
 }
 </script>
 </body>
@@ -122,25 +197,102 @@ function run() {
 
 		def get_stream(self):
 			self.stream = Queue()
-			temp_data = self.owner.streamdata
-			i=0
-			for x in temp_data:
-				self.wfile.write(x)
-				i+=len(x)
-			print(f"<<preloaded {i} bytes>>")
-			self.owner.streams.append(self)
+			# Register under the lock so no chunk is missed or repeated between the preload and the queue
+			with self.owner.streamlock:
+				temp_data = list(self.owner.streamdata)
+				self.owner.streams.append(self)
 			try:
+				for x in temp_data:
+					self.wfile.write(x)
 				while True:
 					chunk=self.stream.get(True, None)
 					self.wfile.write(chunk)
-					print(f"<<sent {len(chunk)} bytes>>")
-				
 			finally:
-				self.owner.streams.remove(self)
+				with self.owner.streamlock:
+					self.owner.streams.remove(self)
 
 		def get_ping(self):
+			query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+			try:
+				self.owner._viewers[self.client_address[0]] = (int(query["w"][0]), int(query["h"][0]), time.monotonic())
+			except (KeyError, ValueError):
+				pass
 			self.wfile.write(self.owner.on_get_snapshot())
 
+		def _websocket_messages(self):
+			"""Yield (opcode, payload) for each WebSocket message from the client, reassembling fragments."""
+			message = b''
+			opcode = 0
+			while True:
+				head = self.rfile.read(2)
+				if len(head) < 2:
+					return
+				length = head[1] & 0x7f
+				if length == 126:
+					(length,) = struct.unpack(">H", self.rfile.read(2))
+				elif length == 127:
+					(length,) = struct.unpack(">Q", self.rfile.read(8))
+				mask = self.rfile.read(4) if head[1] & 0x80 else None
+				payload = self.rfile.read(length)
+				if mask is not None:
+					payload = (int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (length // 4 + 1))[:length], 'big')).to_bytes(length, 'big')
+				if head[0] & 0x08:
+					yield (head[0] & 0x0f, payload) # control frames can arrive between fragments
+					continue
+				if head[0] & 0x0f:
+					opcode = head[0] & 0x0f
+				message += payload
+				if head[0] & 0x80:
+					yield (opcode, message)
+					message = b''
+
+		def get_microphone(self):
+			key = self.headers.get("Sec-WebSocket-Key")
+			if key is None or self.headers.get("Upgrade", "").lower() != "websocket":
+				self.send_error(400, "Expected a WebSocket")
+				return
+			self.protocol_version = "HTTP/1.1" # browsers won't upgrade a 1.0 response
+			self.send_response(101)
+			self.send_header("Upgrade", "websocket")
+			self.send_header("Connection", "Upgrade")
+			self.send_header("Sec-WebSocket-Accept", base64.b64encode(hashlib.sha1((key + _websocket_guid).encode('ascii')).digest()).decode('ascii'))
+			self.end_headers()
+			rate = None
+			for (opcode, payload) in self._websocket_messages():
+				if opcode == 1:
+					try:
+						rate = float(simplejson.loads(payload)["rate"])
+					except (ValueError, KeyError, TypeError):
+						rate = None
+					if rate is None or not 0 < rate < float("inf"):
+						self.wfile.write(bytes([0x88, 2]) + struct.pack(">H", 1007)) # close: invalid payload data
+						break
+				elif opcode == 2 and rate is not None and len(payload) > 8:
+					(delay,) = struct.unpack_from("<d", payload)
+					self.owner.on_microphone(rate, delay, memoryview(payload)[8:])
+				elif opcode == 8:
+					self.wfile.write(bytes([0x88, 0]))
+					break
+				elif opcode == 9:
+					self.wfile.write(bytes([0x8a, len(payload)]) + payload)
+
+		def get_threads(self):
+			self.wfile.write(simplejson.dumps(self.owner.cpu.usage()).encode('utf-8'))
+
+		def get_profile(self):
+			query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query, keep_blank_values=True)
+			try:
+				seconds = min(max(float(query.get("seconds", ["10"])[0]), 0), self.owner.max_profile)
+			except ValueError:
+				self.send_error(400, "Invalid seconds")
+				return
+			stacks = profiler.profile(seconds, idle="idle" in query)
+			self.send_response(200)
+			self.send_header("Content-type", "text/plain; charset=utf-8")
+			self.send_header("Content-Disposition", "attachment; filename=\"profile.folded\"")
+			self.end_headers()
+			self.wfile.write(stacks.encode('utf-8'))
+
 		def do_touch(self, json):
 			self.owner.on_touch(json["type"], json["x"], json["y"])
 			self.wfile.write(simplejson.dumps({"ok": True}).encode('utf-8'))
@@ -149,6 +301,9 @@ function run() {
 			"/": ("text/html; charset=utf-8", get_index),
 			"/stream": ("video/H264", get_stream),
 			"/snapshot": ("image/png", get_ping),
+			"/microphone": (None, get_microphone), # writes its own response
+			"/threads": ("text/json", get_threads),
+			"/profile": (None, get_profile), # e.g. /profile?seconds=30, optionally &idle to include waiting threads
 		}
 
 		posts = {
@@ -162,10 +317,11 @@ function run() {
 			if getter is None:
 				self.send_error(404, "Invalid path")
 				return
-			self.send_response(200)
-			self.send_header("Content-type", getter[0])
-			self.end_headers()
 			try:
+				if getter[0] is not None:
+					self.send_response(200)
+					self.send_header("Content-type", getter[0])
+					self.end_headers()
 				getter[1](self)
 			except (BrokenPipeError, ConnectionResetError):
 				pass
@@ -190,3 +346,8 @@ function run() {
 	def on_get_snapshot(self):
 		"""Callback for when a new PNG is required [called from a web server thread]."""
 		return b''
+
+	def on_microphone(self, rate, delay, samples):
+		"""Callback for microphone audio from the web browser: signed 16-bit mono samples at `rate` Hz, captured
+			`delay` seconds before they were sent [called from a web server thread]."""
+		pass
@@ -9,14 +9,22 @@ import decoder
 import server
 import link
 import protocol
+import microphone
+import profiler
 from threading import Thread
 import time
+import argparse
 
 class Teslabox:
+    min_size = (320, 240)
+    max_size = (1920, 1080)
+    min_fps = 10 # lowest frame rate to ask the phone for
+    decode_budget = 800 * 600 * 60 # default pixels per second this host can decode (what was always requested before)
+    renegotiate_interval = 10 # minimum seconds between renegotiations, so resizing a window doesn't thrash the session
     class _Server(server.Server):
         def __init__(self, owner):
             self._owner = owner
-            super().__init__()
+            super().__init__(port=owner._port)
         def on_touch(self, type, x, y):
             if self._owner.connection is None:
                 return
@@ -24,8 +32,9 @@ class Teslabox:
                 msg = protocol.Touch()
                 types = {"down": protocol.Touch.Action.Down, "up": protocol.Touch.Action.Up, "move": protocol.Touch.Action.Move}
                 msg.action = types[type]
-                msg.x = int(x*10000/800)
-                msg.y = int(y*10000/600)
+                (width, height) = self._owner._screen_size()
+                msg.x = min(max(int(x*10000/width), 0), 10000)
+                msg.y = min(max(int(y*10000/height), 0), 10000)
             else:
                 types = {"down": protocol.MultiTouch.Touch.Action.Down, "up": protocol.MultiTouch.Touch.Action.Up, "move": protocol.MultiTouch.Touch.Action.Move}
                 msg = protocol.MultiTouch()
@@ -36,16 +45,39 @@ class Teslabox:
                 msg.touches.append(tch)
             self._owner.connection.send_message(msg)
         def on_get_snapshot(self):
+            self._owner.decoder.demand()
             return self._owner._frame
+        def on_microphone(self, rate, delay, samples):
+            self._owner.uplink.on_input(rate, delay, samples)
     class _Decoder(decoder.Decoder):
         def __init__(self, owner):
-            super().__init__()
+            super().__init__(owner._decoder_backend)
             self._owner = owner
         def on_frame(self, png):
             self._owner._frame = png
-    class _Connection(link.Connection):
+        def on_keyframe_needed(self):
+            connection = self._owner.connection
+            if connection is None:
+                return
+            try:
+                connection.send_message(protocol.CarPlay(protocol.CarPlay.Value.RequestKeyFrame))
+            except link.Error:
+                pass
+    class _Uplink(microphone.Uplink):
         def __init__(self, owner):
+            self._owner = owner
             super().__init__()
+        def send_message(self, message):
+            connection = self._owner.connection
+            if connection is None:
+                return
+            try:
+                connection.send_message(message)
+            except link.Error:
+                pass
+    class _Connection(link.Connection):
+        def __init__(self, owner):
+            super().__init__(pipeline=owner._usb_pipeline)
             self._owner = owner
         def on_message(self, message):
             if isinstance(message, protocol.Open):
@@ -54,13 +86,24 @@ class Teslabox:
                     self.send_multiple(protocol.opened_info)
             elif isinstance(message, protocol.VideoData):
                 self._owner.decoder.send(message.data)
+            elif isinstance(message, protocol.AudioData) and message.command is not None:
+                self._owner._audio_command(message.command, message.decodeType, message.audioType)
         def on_error(self, error):
             self._owner._disconnect()
-    def __init__(self):
+    def __init__(self, decoder_backend=None, port=9000, usb_pipeline=0, decode_budget=None):
+        self._decoder_backend = decoder_backend
+        if decode_budget is not None:
+            self.decode_budget = decode_budget
+        self._port = port
+        self._usb_pipeline = usb_pipeline
+        self.geometry = (800, 600, 60)
+        self._negotiated = 0
+        self._input_decodetype = 5 # 16kHz mono, unless the dongle configures otherwise
+        self.uplink = self._Uplink(self)
         self._disconnect()
         self.server = self._Server(self)
         self.decoder = self._Decoder(self)
-        self.heartbeat = Thread(target=self._heartbeat_thread)
+        self.heartbeat = profiler.register(Thread(target=self._heartbeat_thread, daemon=True), "heartbeat")
         self.heartbeat.start()
     def _connected(self):
         print("Connected!")
@@ -69,12 +112,70 @@ class Teslabox:
         self.decoder = self._Decoder(self)
     def _disconnect(self):
         if hasattr(self, "connection"):
-            if self.connection is None:
+            # The heartbeat and the USB reader can both get here, so only one of them should see the connection
+            connection = self.connection
+            if connection is None:
                 return
+            self.connection = None
             print("Lost USB device")
+            connection.stop()
         self._frame = b''
         self.connection = None
         self.started = False
+        self.uplink.stop()
+    def _screen_size(self):
+        """The size of the frames being shown, which touches are relative to."""
+        sps = self.decoder.sps
+        if sps is not None:
+            return (sps.width, sps.height)
+        return self.geometry[:2]
+    def _wanted_geometry(self):
+        """Width, height and frame rate to request: enough for the largest viewer, within what we can decode."""
+        viewers = self.server.viewers()
+        if viewers:
+            # The largest viewer's shape; the others scale it down to fit
+            (width, height) = max(viewers, key=lambda x: x[0] * x[1])
+            scale = min(max(1, self.min_size[0] / width, self.min_size[1] / height), self.max_size[0] / width, self.max_size[1] / height)
+        else:
+            (width, height) = self.geometry[:2] # nobody to size for (yet)
+            scale = 1
+        # Viewers only ever see the decoder's output rate, so that's all that needs decoding (None means every frame)
+        fps = min(max(self.decoder.fps or 60, self.min_fps), 60)
+        scale = min(scale, (self.decode_budget / (width * height * fps)) ** 0.5)
+        if viewers or scale < 1:
+            # Even, for 4:2:0 chroma; the phone's encoder pads to whole macroblocks and crops back to this
+            (width, height) = (int(width * scale) // 2 * 2, int(height * scale) // 2 * 2)
+        return (width, height, fps)
+    def _open(self):
+        return protocol.Open(*self.geometry)
+    def _renegotiate(self):
+        wanted = self._wanted_geometry()
+        if wanted == self.geometry or time.monotonic() - self._negotiated < self.renegotiate_interval:
+            return
+        print(f"Renegotiating {wanted[0]}x{wanted[1]} at {wanted[2]}fps")
+        connection = self.connection
+        if connection is None:
+            return
+        self.geometry = wanted
+        self._negotiated = time.monotonic()
+        # The decoder carries on, and restarts itself if the phone does change resolution
+        try:
+            connection.send_message(self._open())
+        except link.Error:
+            self._disconnect()
+    def _audio_command(self, command, decodeType, audioType):
+        if command == protocol.AudioData.Command.AUDIO_INPUT_CONFIG:
+            self._input_decodetype = decodeType
+        elif command in (protocol.AudioData.Command.AUDIO_PHONECALL_START, protocol.AudioData.Command.AUDIO_SIRI_START):
+            try:
+                self.uplink.start(self._input_decodetype, audioType)
+            except ValueError as e:
+                print(f"Microphone unavailable: {e}")
+        elif command in (protocol.AudioData.Command.AUDIO_PHONECALL_STOP, protocol.AudioData.Command.AUDIO_SIRI_STOP):
+            self.uplink.stop()
+            summary = self.uplink.summary()
+            if summary is not None:
+                print(f"Microphone: {summary}")
     def _heartbeat_thread(self):
         while True:
             try:
@@ -94,16 +195,25 @@ class Teslabox:
                     pass
             print("Found USB device...")
             # Second task: transmit startup info
+            self.geometry = self._wanted_geometry()
+            self._negotiated = time.monotonic()
             try:
                 while not self.started:
-                    self.connection.send_multiple(protocol.startup_info)
+                    self.connection.send_multiple(protocol.startup_files + [self._open()])
                     time.sleep(1)
             except:
                 self._disconnect()
             print("Connection started!")
-            # Third task: idle while connected
+            # Third task: idle while connected, following what the viewers need
             while self.started:
                 time.sleep(1)
+                self._renegotiate()
 
 if __name__ == "__main__":
-    Teslabox().run()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=9000, help="web server port")
+    parser.add_argument("--decoder", choices=sorted(decoder.backends), default=decoder.default_backend, help="h264 decoder backend")
+    parser.add_argument("--usb-pipeline", type=int, default=0, help="USB IN transfers to keep in flight (needs python-libusb1), 0 for synchronous pyusb reads")
+    parser.add_argument("--decode-budget", type=float, default=Teslabox.decode_budget, help="pixels per second this host can decode, as suggested by `benchmark.py decoder`; limits the resolution asked for")
+    args = parser.parse_args()
+    Teslabox(decoder_backend=args.decoder, port=args.port, usb_pipeline=args.usb_pipeline, decode_budget=args.decode_budget).run()
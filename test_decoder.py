@@ -0,0 +1,124 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Tests for the decoder's demand-driven suspend and resume, with a backend that just records its input."""
+
+import threading
+import pytest
+import decoder
+from test_h264 import _nal, _escape, _sps
+
+class _Recorder(decoder.Backend):
+    def __init__(self, owner):
+        super().__init__(owner)
+        self.sent = []
+        self.stopped = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+
+    def stop(self):
+        self.release.wait() # e.g. ffmpeg flushing its output
+        self.stopped.set()
+
+class _Decoder(decoder.Decoder):
+    def __init__(self):
+        self.keyframe_requests = 0
+        self.frames = []
+        super().__init__("recorder")
+
+    def on_keyframe_needed(self):
+        self.keyframe_requests += 1
+
+    def on_frame(self, png):
+        self.frames.append(png)
+
+    def idle(self):
+        self._last_demand = 0
+
+@pytest.fixture(autouse=True)
+def _recorder(monkeypatch):
+    monkeypatch.setitem(decoder.backends, "recorder", _Recorder)
+
+SPS = _nal(7, _escape(_sps(800, 600)))
+PPS = _nal(8, b'\xce')
+IDR = _nal(5, b'\x88' + b'i' * 100)
+P = _nal(1, b'\x9a' + b'p' * 100)
+
+def test_decodes_on_demand():
+    dec = _Decoder()
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    dec.send(P)
+    assert dec.backend.sent == [SPS + PPS + IDR, P]
+    assert (dec.sps.width, dec.sps.height) == (800, 600)
+
+def test_idle_resumes_from_gop():
+    dec = _Decoder()
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    dec.idle()
+    dec.send(P)
+    dec.send(P)
+    assert len(dec.backend.sent) == 1
+    dec.demand()
+    dec.send(P)
+    # Everything since the IDR, so the newest picture can be decoded straight away
+    assert dec.backend.sent[1] == SPS + PPS + IDR + P + P + P
+    assert dec.keyframe_requests == 0
+
+def test_resume_adds_parameter_sets():
+    dec = _Decoder()
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    dec.idle()
+    dec.send(IDR)
+    dec.demand()
+    dec.send(P)
+    assert dec.backend.sent[1] == SPS + PPS + IDR + P
+
+def test_gop_limit_stops_feeding_and_requests_keyframe():
+    dec = _Decoder()
+    dec.gop_limit = 250
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    dec.idle()
+    for _ in range(5):
+        dec.send(P)
+    assert len(dec.backend.sent) == 1 # nothing is decoded while idle, however large the GOP
+    dec.demand()
+    dec.send(P)
+    assert len(dec.backend.sent) == 1
+    assert dec.keyframe_requests == 1
+    dec.send(P)
+    assert dec.keyframe_requests == 1 # not again until keyframe_retry
+    dec.send(IDR)
+    assert dec.backend.sent[1] == SPS + PPS + IDR
+
+def test_resize_restarts_backend():
+    dec = _Decoder()
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    old = dec.backend
+    small = _nal(7, _escape(_sps(320, 240)))
+    dec.send(small + PPS + IDR)
+    assert dec.backend is not old
+    assert (dec.sps.width, dec.sps.height) == (320, 240)
+    assert dec.backend.sent == [small + PPS + IDR]
+
+def test_resize_stops_old_backend_in_background():
+    dec = _Decoder()
+    dec.demand()
+    dec.send(SPS + PPS + IDR)
+    old = dec.backend
+    old.release.clear() # a slow stop doesn't hold up send()
+    dec.send(_nal(7, _escape(_sps(320, 240))) + PPS + IDR)
+    assert not old.stopped.is_set()
+    old._output(b'old')
+    dec.backend._output(b'new')
+    assert dec.frames == [b'new'] # frames flushed by the old backend are dropped
+    old.release.set()
+    assert old.stopped.wait(5)
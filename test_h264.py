@@ -0,0 +1,113 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Tests for the H.264 Annex B parser."""
+
+import pytest
+import h264
+
+class _BitWriter:
+    def __init__(self):
+        self.bits = []
+
+    def u(self, count, value):
+        self.bits += [(value >> (count - 1 - i)) & 1 for i in range(count)]
+
+    def ue(self, value):
+        code = value + 1
+        self.u(code.bit_length() * 2 - 1, code)
+
+    def rbsp(self):
+        bits = self.bits + [1] # rbsp_stop_one_bit
+        bits += [0] * (-len(bits) % 8)
+        return bytes(int("".join(map(str, bits[i:i + 8])), 2) for i in range(0, len(bits), 8))
+
+def _sps(width, height, profile=66, crop=True):
+    writer = _BitWriter()
+    writer.u(8, profile)
+    writer.u(8, 0)
+    writer.u(8, 31)
+    writer.ue(0) # seq_parameter_set_id
+    if profile == 100:
+        writer.ue(1) # chroma_format_idc
+        writer.ue(0)
+        writer.ue(0)
+        writer.u(1, 0)
+        writer.u(1, 0) # no scaling matrix
+    writer.ue(0) # log2_max_frame_num_minus4
+    writer.ue(0) # pic_order_cnt_type
+    writer.ue(0)
+    writer.ue(1) # max_num_ref_frames
+    writer.u(1, 0)
+    mbs = ((width + 15) // 16, (height + 15) // 16)
+    writer.ue(mbs[0] - 1)
+    writer.ue(mbs[1] - 1)
+    writer.u(1, 1) # frame_mbs_only_flag
+    writer.u(1, 1)
+    cropped = (mbs[0] * 16 - width, mbs[1] * 16 - height)
+    writer.u(1, 1 if crop and any(cropped) else 0)
+    if crop and any(cropped):
+        for x in (0, cropped[0] // 2, 0, cropped[1] // 2):
+            writer.ue(x)
+    writer.u(1, 0) # no VUI
+    return writer.rbsp()
+
+def _escape(rbsp):
+    out = bytearray()
+    zeros = 0
+    for x in rbsp:
+        if zeros >= 2 and x <= 3:
+            out.append(3)
+            zeros = 0
+        out.append(x)
+        zeros = zeros + 1 if x == 0 else 0
+    return bytes(out)
+
+def _nal(type, payload=b'\x88\x84', ref_idc=3, long_code=True):
+    return (b'\0\0\0\1' if long_code else b'\0\0\1') + bytes([(ref_idc << 5) | type]) + payload
+
+def test_start_codes():
+    data = b'junk' + _nal(7, b'\x42') + _nal(8, b'\xce', long_code=False)
+    assert list(h264.start_codes(data)) == [(4, 8), (10, 13)]
+
+def test_units():
+    data = _nal(7, b'\x42') + _nal(8, b'\xce') + _nal(5, ref_idc=3) + _nal(1, ref_idc=0, long_code=False)
+    found = h264.units(memoryview(data))
+    assert [x.type for x in found] == [h264.NALType.SPS, h264.NALType.PPS, h264.NALType.IDR, h264.NALType.Slice]
+    assert [x.is_vcl for x in found] == [False, False, True, True]
+    assert found[2].ref_idc == 3 and found[3].ref_idc == 0
+    assert found[0].raw() == _nal(7, b'\x42')
+    assert b''.join(x.raw() for x in found) == data
+
+def test_unknown_type():
+    assert h264.units(_nal(24))[0].type == 24
+
+def test_rbsp_removes_emulation_prevention():
+    unit = h264.units(_nal(6, b'\x01\0\0\3\1\0\0\3\0'))[0]
+    assert unit.rbsp() == b'\x01\0\0\1\0\0\0'
+
+def test_access_units():
+    first = _nal(9, b'\x10') + _nal(7, b'\x42') + _nal(8, b'\xce') + _nal(5, b'\x88') + _nal(5, b'\x40') # two slices
+    second = _nal(1, b'\x9a')
+    third = _nal(9, b'\x30') + _nal(1, b'\x9a')
+    assert h264.access_units(first + second + third) == [first, second, third]
+
+@pytest.mark.parametrize("width,height,profile", [(1920, 1080, 66), (800, 600, 66), (1280, 720, 100), (320, 240, 100)])
+def test_sps_geometry(width, height, profile):
+    sps = h264.SPS(_sps(width, height, profile))
+    assert (sps.width, sps.height) == (width, height)
+    assert sps.profile_idc == profile
+
+def test_sps_through_nal_unit():
+    data = _nal(7, _escape(_sps(1920, 1080)))
+    sps = h264.SPS(h264.units(data)[0].rbsp())
+    assert (sps.width, sps.height) == (1920, 1080)
+
+def test_sps_uncropped():
+    sps = h264.SPS(_sps(1920, 1080, crop=False))
+    assert (sps.width, sps.height) == (1920, 1088)
+
+def test_sps_truncated():
+    with pytest.raises(ValueError):
+        h264.SPS(_sps(1920, 1080)[:4])
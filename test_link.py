@@ -0,0 +1,63 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Tests for the USB connection, against link.FakeDevice."""
+
+import threading
+import pytest
+import link
+import protocol
+
+@pytest.fixture
+def device():
+    return link.FakeDevice(latency=0, bandwidth=1e12)
+
+def test_send_writes_header_then_body(device):
+    connection = link.Connection(device=device)
+    try:
+        sent = [protocol.SendFile("/tmp/long_name", b'x' * 5000), protocol.Open(1280, 720, 30), protocol.Heartbeat()]
+        connection.send_multiple(sent)
+    finally:
+        connection.stop()
+    expected = []
+    for msg in sent:
+        data = msg.serialise()
+        expected += [data[:msg.headersize], data[msg.headersize:]]
+    assert device.written == expected
+
+def _received(device, pipeline, count):
+    messages = []
+    done = threading.Event()
+    class _Recorder(link.Connection):
+        def on_message(self, message):
+            messages.append(message)
+            if len(messages) == count:
+                done.set()
+        def on_error(self, error):
+            messages.append(error)
+            done.set()
+    connection = _Recorder(device=device, pipeline=pipeline)
+    try:
+        assert done.wait(10)
+    finally:
+        connection.stop()
+    return messages
+
+@pytest.mark.parametrize("pipeline", [0, 1, 4])
+def test_receive_order_and_content(device, pipeline):
+    sent = []
+    for i in range(50):
+        msg = protocol.VideoData()
+        msg.width = i
+        msg.data = bytes([i]) * (i * 1000 if i % 10 else link.Connection.transfer_size + i) # some span transfers
+        sent.append(msg)
+        if i % 7 == 0:
+            sent.append(protocol.Heartbeat())
+        if i % 11 == 0:
+            sent.append(protocol.Plugged(True))
+    for msg in sent:
+        device.inject_message(msg)
+    received = _received(device, pipeline, len(sent))
+    assert [type(x) for x in received] == [type(x) for x in sent]
+    assert [x.serialise() for x in received] == [x.serialise() for x in sent]
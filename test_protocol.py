@@ -0,0 +1,179 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Tests for the dongle protocol: message round trips, malformed input and stream reassembly."""
+
+import struct
+import pytest
+import protocol
+
+def _fields(msg):
+    # Compare types too, as True == 1 and an IntEnum equals its value
+    return {k: [_fields(x) for x in v] if isinstance(v, list) else (type(v), v) for k, v in vars(msg).items()}
+
+def _roundtrip(msg):
+    data = msg.serialise()
+    assert type(data) is bytes
+    assert len(data) == msg.size()
+    back = protocol.Message.unpack_from(data)
+    assert type(back) is type(msg)
+    assert _fields(back) == _fields(msg)
+    return back
+
+def _audio(**values):
+    msg = protocol.AudioData()
+    msg.decodeType = 5
+    msg.volume = 0.5
+    msg.audioType = 3
+    for (name, value) in values.items():
+        setattr(msg, name, value)
+    return msg
+
+def _plugged(wifistyle, wifi):
+    msg = protocol.Plugged(wifistyle)
+    msg.phone_type = 3
+    msg.wifi = wifi
+    return msg
+
+def _multitouch(count):
+    msg = protocol.MultiTouch()
+    for i in range(count):
+        touch = protocol.MultiTouch.Touch()
+        touch.x = i / 4
+        touch.y = 1 - i / 4
+        touch.action = protocol.MultiTouch.Touch.Action.Move
+        touch.id = i
+        msg.touches.append(touch)
+    return msg
+
+def _videodata():
+    msg = protocol.VideoData()
+    msg.width = 800
+    msg.height = 600
+    msg.data = bytes(range(256)) * 10
+    return msg
+
+def _touch():
+    msg = protocol.Touch()
+    msg.action = protocol.Touch.Action.Down
+    msg.x = 5000
+    msg.y = 10000
+    return msg
+
+@pytest.mark.parametrize("cls", sorted(protocol.Message._allmessages().values(), key=lambda x: x.msgtype), ids=lambda x: x.__name__)
+def test_default_roundtrip(cls):
+    msg = cls()
+    if isinstance(msg, protocol.AudioData):
+        msg.data = b'\1\2' * 100 # one of the Switch branches must be set
+    _roundtrip(msg)
+
+@pytest.mark.parametrize("msg", [
+    _audio(data=b'\0\1' * 512),
+    _audio(command=protocol.AudioData.Command.AUDIO_SIRI_START),
+    _audio(volumeDuration=1234),
+    _plugged(False, False),
+    _plugged(True, True),
+    _plugged(True, False),
+    _multitouch(0),
+    _multitouch(3),
+    _videodata(),
+    _touch(),
+    protocol.Open(1920, 1080, 10),
+    protocol.SendFile("/tmp/name", b'\0contents\0'),
+    protocol.CarPlay(protocol.CarPlay.Value.RequestKeyFrame),
+    protocol.CarPlay(4321),
+    protocol.SoftwareVersion("2021.03.04.1234"),
+], ids=lambda x: type(x).__name__)
+def test_roundtrip(msg):
+    _roundtrip(msg)
+
+def test_audio_switch_branches():
+    assert _roundtrip(_audio(command=protocol.AudioData.Command.AUDIO_PHONECALL_STOP)).data is None
+    back = _roundtrip(_audio(volumeDuration=7))
+    assert back.command is None and back.data is None
+    with pytest.raises(ValueError):
+        _audio().serialise() # no branch set
+
+def test_plugged_without_wifi_is_short():
+    assert len(_plugged(False, True).serialise()) == protocol.Message.headersize + 4
+    assert protocol.Message.unpack_from(_plugged(True, True).serialise()).wifi is True
+
+def test_pack_into_matches_serialise():
+    for msg in (protocol.Open(), _videodata(), _audio(command=protocol.AudioData.Command.AUDIO_SIRI_STOP)):
+        buffer = bytearray(b'\xff' * (msg.size() + 10))
+        assert msg.pack_into(buffer, 5) == 5 + msg.size()
+        assert buffer[5:5 + msg.size()] == msg.serialise()
+        assert buffer[:5] == b'\xff' * 5 and buffer[5 + msg.size():] == b'\xff' * 5
+
+def _with_body(msg, body):
+    return struct.pack("<LLLL", protocol.Message.magic, len(body), msg.type, (msg.type ^ -1) & 0xffffffff) + body
+
+@pytest.mark.parametrize("msg", [protocol.Open(), _touch(), protocol.SendFile("/tmp/x", b'abc'), _multitouch(2)], ids=lambda x: type(x).__name__)
+def test_truncated_body_is_unknown(msg):
+    body = msg.serialise()[protocol.Message.headersize:]
+    back = protocol.Message.unpack_from(_with_body(msg, body[:len(body) // 2 - 1]))
+    assert type(back) is protocol.Unknown
+    assert back.type == msg.type
+
+def test_truncated_fixed_part_is_unknown():
+    msg = _videodata()
+    back = protocol.Message.unpack_from(_with_body(msg, msg.serialise()[protocol.Message.headersize:][:18]))
+    assert type(back) is protocol.Unknown
+
+@pytest.mark.parametrize("msg", [protocol.Open(), _touch(), protocol.SendFile("/tmp/x", b'abc'), _multitouch(2)], ids=lambda x: type(x).__name__)
+def test_trailing_bytes_are_unknown(msg):
+    body = msg.serialise()[protocol.Message.headersize:]
+    back = protocol.Message.unpack_from(_with_body(msg, body + b'\0' * 3))
+    assert type(back) is protocol.Unknown
+
+def test_unknown_type_keeps_body():
+    data = struct.pack("<LLLL", protocol.Message.magic, 3, 999, (999 ^ -1) & 0xffffffff) + b'abc'
+    back = protocol.Message.unpack_from(data)
+    assert type(back) is protocol.Unknown
+    assert back.type == 999
+    assert back.serialise() == data
+
+def test_bad_headers():
+    data = bytearray(protocol.Open().serialise())
+    with pytest.raises(ValueError):
+        protocol.Message.unpack_from(data[:-1])
+    data[8] ^= 1 # type no longer matches its check
+    with pytest.raises(ValueError):
+        protocol.Message.unpack_header(data)
+    data = bytearray(protocol.Open().serialise())
+    data[0] ^= 1
+    with pytest.raises(ValueError):
+        protocol.Message.unpack_header(data)
+
+def _stream(*messages):
+    return b''.join(x.serialise() for x in messages)
+
+def test_parser_partial_feeds():
+    messages = [protocol.Open(), _videodata(), protocol.Heartbeat(), _audio(volumeDuration=3)]
+    data = _stream(*messages)
+    parser = protocol.Parser()
+    out = []
+    for i in range(0, len(data), 7):
+        out += parser.feed(data[i:i + 7])
+    assert [_fields(x) for x in out] == [_fields(x) for x in messages]
+    assert parser.discarded == 0
+
+def test_parser_whole_and_memoryview():
+    messages = [_touch(), _touch(), _multitouch(1)]
+    out = protocol.Parser().feed(memoryview(bytearray(_stream(*messages))))
+    assert [_fields(x) for x in out] == [_fields(x) for x in messages]
+
+def test_parser_resyncs_after_junk():
+    parser = protocol.Parser()
+    junk = b'\x55\xaa\x55\xaa' + b'garbage'
+    out = parser.feed(_stream(_touch()) + junk + _stream(protocol.Open()))
+    assert [type(x) for x in out] == [protocol.Touch, protocol.Open]
+    assert parser.discarded == len(junk)
+
+def test_parser_waits_for_body():
+    data = _stream(_videodata())
+    parser = protocol.Parser()
+    assert parser.feed(data[:protocol.Message.headersize + 10]) == []
+    out = parser.feed(data[protocol.Message.headersize + 10:])
+    assert len(out) == 1 and out[0].data == _videodata().data
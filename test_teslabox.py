@@ -0,0 +1,40 @@
+# "Autobox" dongle driver for HTML 'streaming'
+# Created by Colin Munro, December 2019
+# See README.md for more information
+
+"""Tests for choosing the video geometry to ask the phone for."""
+
+from types import SimpleNamespace
+import pytest
+import teslabox
+
+def _box(viewers, fps=7, budget=teslabox.Teslabox.decode_budget, geometry=(800, 600, 60)):
+    # Without __init__, so no web server, USB or threads
+    box = teslabox.Teslabox.__new__(teslabox.Teslabox)
+    box.server = SimpleNamespace(viewers=lambda: viewers)
+    box.decoder = SimpleNamespace(fps=fps)
+    box.decode_budget = budget
+    box.geometry = geometry
+    return box
+
+def test_sizes_for_viewer():
+    assert _box([(1920, 1080)])._wanted_geometry() == (1920, 1080, 10) # no rounding to 1072
+
+def test_largest_viewer_keeps_its_shape():
+    assert _box([(1280, 720), (600, 1000)])._wanted_geometry()[:2] == (1280, 720)
+
+@pytest.mark.parametrize("viewer, wanted", [((3840, 2160), (1920, 1080)), ((1000, 2000), (540, 1080)), ((160, 90), (426, 240))])
+def test_clamped_keeping_aspect(viewer, wanted):
+    assert _box([viewer])._wanted_geometry()[:2] == wanted
+
+def test_every_frame_decoded():
+    (width, height, fps) = _box([(1920, 1080)], fps=None)._wanted_geometry()
+    assert fps == 60
+    assert width * height * fps <= teslabox.Teslabox.decode_budget
+    assert abs(width / height - 1920 / 1080) < 0.01
+    assert width % 2 == 0 and height % 2 == 0
+
+def test_no_viewers_keeps_geometry_within_budget():
+    assert _box([], budget=1e12)._wanted_geometry() == (800, 600, 10)
+    (width, height, fps) = _box([], budget=800 * 600 * 10 / 4)._wanted_geometry()
+    assert (width, height) == (400, 300)